@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Synthetic workloads for charmhelpers.core.unitdata.Storage.
+
+Each workload runs against a fresh database in a temporary directory and
+reports operations per second and latency percentiles, e.g.:
+
+    python benchmarks/unitdata_bench.py --keys 5000 --cache
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'hooks'))
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+
+def _value(i, version=0):
+    return {'address': '10.0.%d.%d' % (i // 256 % 256, i % 256),
+            'hostname': 'juju-machine-%d' % i,
+            'version': version}
+
+
+def _timed(op, count):
+    latencies = []
+    for i in range(count):
+        start = timeit.default_timer()
+        op(i)
+        latencies.append(timeit.default_timer() - start)
+    return latencies
+
+
+def bench_set(db, args):
+    """Many small sets, flushed once at the end"""
+    latencies = _timed(lambda i: db.set('unit.%d' % i, _value(i)),
+                       args.keys)
+    db.flush()
+    return latencies
+
+
+def bench_update(db, args):
+    """Bulk update() of the whole mapping, a tenth of it changed"""
+    def op(i):
+        db.update(dict(('unit.%d' % k, _value(k, i if k % 10 == 0 else 0))
+                       for k in range(args.keys)))
+        db.flush()
+    return _timed(op, args.rounds)
+
+
+def bench_getrange(db, args):
+    """getrange() over a large prefix, decoding every value"""
+    db.update(dict(('unit.%d' % k, _value(k)) for k in range(args.keys)))
+    db.update(dict(('other.%d' % k, k) for k in range(args.keys)))
+    db.flush()
+    return _timed(lambda i: list(db.getrange('unit.').values()),
+                  args.rounds)
+
+
+def bench_delta(db, args):
+    """delta() of a big mapping against the stored one, 1% changed"""
+    mapping = dict((str(k), _value(k)) for k in range(args.keys))
+    db.update(mapping, prefix='rels.')
+    db.flush()
+
+    def op(i):
+        current = dict(mapping)
+        for k in range(i % 100, args.keys, 100):
+            current[str(k)] = _value(k, i + 1)
+        db.delta(current, 'rels.')
+    return _timed(op, args.rounds)
+
+
+def bench_hook_scope(db, args):
+    """Hook executions each changing a few keys, recording history"""
+    def op(i):
+        with db.hook_scope('bench-%d' % i):
+            for k in range(10):
+                db.set('unit.%d' % ((i * 10 + k) % args.keys), _value(k, i))
+        db.flush()
+    return _timed(op, args.keys // 10)
+
+
+WORKLOADS = (
+    ('set', bench_set),
+    ('update', bench_update),
+    ('getrange', bench_getrange),
+    ('delta', bench_delta),
+    ('hook_scope', bench_hook_scope),
+)
+
+
+def percentile(latencies, pct):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def run(name, workload, args):
+    tmpdir = tempfile.mkdtemp(prefix='unitdata-bench-')
+    try:
+        db = unitdata.Storage(os.path.join(tmpdir, 'unit-state.db'),
+                              journal_mode=args.journal_mode,
+                              synchronous=args.synchronous,
+                              cache=args.cache, codec=args.codec)
+        try:
+            latencies = workload(db, args)
+        finally:
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    total = sum(latencies)
+    return (name, len(latencies), len(latencies) / total if total else 0,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=2000,
+                        help='keys per workload (default: %(default)s)')
+    parser.add_argument('--rounds', type=int, default=50,
+                        help='repetitions of bulk operations '
+                             '(default: %(default)s)')
+    parser.add_argument('--journal-mode',
+                        choices=unitdata.Storage.JOURNAL_MODES)
+    parser.add_argument('--synchronous',
+                        choices=unitdata.Storage.SYNCHRONOUS_LEVELS)
+    parser.add_argument('--codec', choices=unitdata.Storage.CODECS,
+                        default='json')
+    parser.add_argument('--cache', action='store_true',
+                        help='use the read-through cache')
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help='workloads to run: %s (default: all)' %
+                             ', '.join(name for name, _ in WORKLOADS))
+    args = parser.parse_args(argv)
+
+    selected = [(name, workload) for name, workload in WORKLOADS
+                if not args.workloads or name in args.workloads]
+    print('%-12s %8s %12s %10s %10s' % ('workload', 'ops', 'ops/sec',
+                                        'p50 ms', 'p99 ms'))
+    for name, workload in selected:
+        print('%-12s %8d %12.1f %10.3f %10.3f' % run(name, workload, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -53,7 +53,7 @@ from charmhelpers.core.hookenv import (
 )
 from charmhelpers.core.host import (
     mount,
-    mounts,
+    mount_table,
     service_start,
     service_stop,
     service_running,
@@ -781,7 +781,7 @@ def map_block_storage(service, pool, image):
 
 def filesystem_mounted(fs):
     """Determine whether a filesytems is already mounted."""
-    return fs in [f for f, m in mounts()]
+    return fs in mount_table()
 
 
 def make_filesystem(blk_device, fstype='ext4', timeout=10):
@@ -19,6 +19,7 @@
 
 import io
 import os
+import tempfile
 
 __author__ = 'Jorge Niedbalski R. <jorge.niedbalski@canonical.com>'
 
@@ -121,14 +122,138 @@ class Fstab(io.FileIO):
 
     @classmethod
     def remove_by_mountpoint(cls, mountpoint, path=None):
-        fstab = cls(path=path)
-        entry = fstab.get_entry_by_attr('mountpoint', mountpoint)
-        if entry:
-            return fstab.remove_entry(entry)
-        return False
+        with FstabEditor(path=path) as fstab:
+            return fstab.remove_by_mountpoint(mountpoint)
 
     @classmethod
     def add(cls, device, mountpoint, filesystem, options=None, path=None):
-        return cls(path=path).add_entry(Fstab.Entry(device,
-                                                    mountpoint, filesystem,
-                                                    options=options))
+        with FstabEditor(path=path) as fstab:
+            return fstab.add_entry(Fstab.Entry(device,
+                                               mountpoint, filesystem,
+                                               options=options))
+
+
+def normalize_device(device):
+    """Return the canonical device node for an fstab device spec.
+
+    ``UUID=`` and ``LABEL=`` specs are resolved through ``/dev/disk``, and
+    symlinks such as ``/dev/mapper`` names are followed. Specs which do not
+    resolve to an existing path (``tmpfs``, ``nodev``, remote filesystems)
+    are returned unchanged.
+    """
+    for tag, directory in (('UUID=', 'by-uuid'), ('LABEL=', 'by-label')):
+        if device.startswith(tag):
+            path = os.path.join('/dev/disk', directory, device[len(tag):])
+            break
+    else:
+        path = device
+    if path.startswith('/') and os.path.exists(path):
+        return os.path.realpath(path)
+    return device
+
+
+class FstabEditor(object):
+    """Indexed, batched editor for `/etc/fstab`.
+
+    Entries are indexed by normalized device and by mountpoint. Changes
+    are kept in memory until :meth:`commit` (or leaving the ``with``
+    block), which rewrites the file once, atomically; lines which were
+    not changed, including comments, are preserved as they were.
+    """
+
+    def __init__(self, path=None):
+        self._path = path or Fstab.DEFAULT_PATH
+        self.dirty = False
+        with io.open(self._path, encoding='us-ascii') as f:
+            self._lines = [self._parse(line) for line in f]
+        self._by_device = {}
+        self._by_mountpoint = {}
+        for _, entry in self._lines:
+            if entry is not None:
+                self._index(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commit()
+
+    def _parse(self, line):
+        if line.strip() and not line.strip().startswith("#"):
+            try:
+                return line, Fstab.Entry(*line.split())
+            except (TypeError, ValueError):
+                pass
+        return line, None
+
+    def _index(self, entry):
+        self._by_device.setdefault(normalize_device(entry.device), entry)
+        self._by_mountpoint.setdefault(
+            os.path.normpath(entry.mountpoint), entry)
+
+    @property
+    def entries(self):
+        return [entry for _, entry in self._lines if entry is not None]
+
+    def get_entry_by_device(self, device):
+        return self._by_device.get(normalize_device(device))
+
+    def get_entry_by_mountpoint(self, mountpoint):
+        return self._by_mountpoint.get(os.path.normpath(mountpoint))
+
+    def add_entry(self, entry):
+        if self.get_entry_by_device(entry.device):
+            return False
+        if self._lines and not self._lines[-1][0].endswith('\n'):
+            line, e = self._lines[-1]
+            self._lines[-1] = (line + '\n', e)
+        self._lines.append((str(entry) + '\n', entry))
+        self._index(entry)
+        self.dirty = True
+        return entry
+
+    def remove_entry(self, entry):
+        for index, (_, e) in enumerate(self._lines):
+            if e is not None and e == entry:
+                break
+        else:
+            return False
+        del self._lines[index]
+        self._by_device = {}
+        self._by_mountpoint = {}
+        for e in self.entries:
+            self._index(e)
+        self.dirty = True
+        return True
+
+    def remove_by_mountpoint(self, mountpoint):
+        entry = self.get_entry_by_mountpoint(mountpoint)
+        if entry:
+            return self.remove_entry(entry)
+        return False
+
+    def commit(self):
+        """Write pending changes, replacing the file atomically"""
+        if not self.dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self._path))
+        st = os.stat(self._path)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.fstab.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join(line for line, _ in self._lines)
+                        .encode('us-ascii'))
+                f.flush()
+                os.fchmod(f.fileno(), st.st_mode & 0o7777)
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fsync(f.fileno())
+            os.rename(tmp, self._path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.dirty = False
@@ -21,10 +21,12 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import contextlib
 import copy
 from distutils.version import LooseVersion
 from functools import wraps
 import glob
+import hashlib
 import os
 import json
 import yaml
@@ -32,6 +34,7 @@ import subprocess
 import sys
 import errno
 import tempfile
+import time
 from subprocess import CalledProcessError
 
 import six
@@ -89,6 +92,124 @@ def flush(key):
         del cache[item]
 
 
+class SubprocessHookTools(object):
+    """Hook tool backend which runs the real Juju hook tools.
+
+    A backend provides ``call``, ``check_call`` and ``check_output`` with
+    the semantics of their :mod:`subprocess` namesakes. Every hook tool
+    invocation in this module goes through the active backend, see
+    :func:`set_hook_tools`.
+    """
+
+    def call(self, cmd, **kwargs):
+        return subprocess.call(cmd, **kwargs)
+
+    def check_call(self, cmd, **kwargs):
+        return subprocess.check_call(cmd, **kwargs)
+
+    def check_output(self, cmd, **kwargs):
+        return subprocess.check_output(cmd, **kwargs)
+
+
+class TracingHookTools(object):
+    """Hook tool backend wrapper which counts and times every invocation.
+
+    :meth:`Hooks.trace` wraps the active backend with one of these for
+    each hook, and records the :meth:`report` in unitdata under
+    ``hookenv.trace.<hook name>``.
+    """
+
+    # Invocations slower than this many seconds are listed in the report.
+    SLOW_CALL_SECONDS = 1.0
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = {}
+        self.slow_calls = []
+
+    def call(self, cmd, **kwargs):
+        return self._trace('call', cmd, kwargs)
+
+    def check_call(self, cmd, **kwargs):
+        return self._trace('check_call', cmd, kwargs)
+
+    def check_output(self, cmd, **kwargs):
+        return self._trace('check_output', cmd, kwargs)
+
+    def _trace(self, method, cmd, kwargs):
+        start = time.time()
+        try:
+            return getattr(self.backend, method)(cmd, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            stats = self.calls.setdefault(tuple(cmd), [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed >= self.SLOW_CALL_SECONDS:
+                self.slow_calls.append((list(cmd), elapsed))
+
+    def by_tool(self):
+        """Return {tool: [invocations, seconds]}"""
+        tools = {}
+        for cmd, (count, elapsed) in self.calls.items():
+            stats = tools.setdefault(cmd[0], [0, 0.0])
+            stats[0] += count
+            stats[1] += elapsed
+        return tools
+
+    def report(self):
+        """Return the trace as a JSON serializable dict.
+
+        Only tool names and timings are included, as arguments may carry
+        secrets such as relation-set passwords; see :attr:`calls` for the
+        full command lines.
+        """
+        tools = self.by_tool()
+        return {
+            'forks': sum(count for count, _ in tools.values()),
+            'seconds': sum(elapsed for _, elapsed in tools.values()),
+            'tools': tools,
+            'slow': [{'tool': cmd[0], 'seconds': elapsed}
+                     for cmd, elapsed in self.slow_calls],
+        }
+
+    def summary(self, top=3):
+        """Return a one line summary such as
+        '37 forks, 2.1 s, top: relation-get x22, config-get x5'"""
+        report = self.report()
+        tools = sorted(report['tools'].items(),
+                       key=lambda t: (-t[1][0], t[0]))[:top]
+        summary = '{} forks, {:.1f} s'.format(report['forks'],
+                                              report['seconds'])
+        if tools:
+            summary += ', top: ' + ', '.join(
+                '{} x{}'.format(tool, stats[0]) for tool, stats in tools)
+        if report['slow']:
+            summary += ', {} slow'.format(len(report['slow']))
+        return summary
+
+
+_hook_tools = SubprocessHookTools()
+
+
+def hook_tools():
+    """Return the active hook tool backend"""
+    return _hook_tools
+
+
+def set_hook_tools(backend):
+    """Replace the hook tool backend, returning the previous one.
+
+    Cached hook tool results are discarded, since they came from the
+    previous backend.
+    """
+    global _hook_tools
+    previous = _hook_tools
+    _hook_tools = backend
+    cache.clear()
+    return previous
+
+
 def log(message, level=None):
     """Write a message to the juju log"""
     command = ['juju-log']
@@ -100,7 +221,7 @@ def log(message, level=None):
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
-        subprocess.call(command)
+        _hook_tools.call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             if level:
@@ -264,6 +385,8 @@ class Config(dict):
         super(Config, self).__init__(*args, **kw)
         self.implicit_save = True
         self._prev_dict = None
+        self._changed_keys = None
+        self._removed_keys = frozenset()
         self.path = os.path.join(charm_dir(), Config.CONFIG_FILE_NAME)
         if os.path.exists(self.path):
             self.load_previous()
@@ -286,10 +409,51 @@ class Config(dict):
         self.path = path or self.path
         with open(self.path) as f:
             self._prev_dict = json.load(f)
+        dropped = [k for k, v in self._prev_dict.items()
+                   if k not in self and v is not None]
+        if dropped:
+            options = self._declared_options()
+            self._removed_keys = frozenset(k for k in dropped
+                                           if k in options)
+        self._changed_keys = frozenset(
+            k for k in self if self._prev_dict.get(k) != self[k]).union(
+            self._removed_keys)
         for k, v in copy.deepcopy(self._prev_dict).items():
-            if k not in self:
+            if k not in self and k not in self._removed_keys:
                 self[k] = v
 
+    def _declared_options(self):
+        path = os.path.join(charm_dir() or '', 'config.yaml')
+        try:
+            with open(path) as f:
+                return (yaml.safe_load(f) or {}).get('options') or {}
+        except IOError:
+            return {}
+
+    @property
+    def changed_keys(self):
+        """The set of keys whose value differs from the previous hook.
+
+        Includes :attr:`removed_keys`. Computed once when the previous
+        config is loaded, so membership tests are O(1). If there is no
+        previous config, every key is considered changed.
+
+        """
+        if self._changed_keys is None:
+            return frozenset(self)
+        return self._changed_keys
+
+    @property
+    def removed_keys(self):
+        """The set of options declared in config.yaml which had a value in
+        the previous hook but have none now.
+
+        Unlike values stored by the charm itself, these are not carried
+        over from the previous config.
+
+        """
+        return self._removed_keys
+
     def changed(self, key):
         """Return True if the current value for this key is different from
         the previous value.
@@ -297,8 +461,19 @@ class Config(dict):
         """
         if self._prev_dict is None:
             return True
+        if key in self._changed_keys:
+            return True
         return self.previous(key) != self.get(key)
 
+    def any_changed(self, *keys):
+        """Return True if any of the given keys has changed since the
+        previous hook.
+
+        """
+        if self._prev_dict is None:
+            return True
+        return any(self.changed(k) for k in keys)
+
     def previous(self, key):
         """Return previous value for this key, or None if there
         is no previous value.
@@ -337,7 +512,7 @@ def config(scope=None):
     config_cmd_line.append('--format=json')
     try:
         config_data = json.loads(
-            subprocess.check_output(config_cmd_line).decode('UTF-8'))
+            _hook_tools.check_output(config_cmd_line).decode('UTF-8'))
         if scope is not None:
             return config_data
         return Config(config_data)
@@ -356,7 +531,7 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_hook_tools.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -369,7 +544,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
     relation_settings = relation_settings if relation_settings else {}
     relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
+    accepts_file = "--file" in _hook_tools.check_output(
         relation_cmd_line + ["--help"], universal_newlines=True)
     if relation_id is not None:
         relation_cmd_line.extend(('-r', relation_id))
@@ -387,7 +562,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # stdin, but that feature is broken in 1.23.2: Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
-        subprocess.check_call(
+        _hook_tools.check_call(
             relation_cmd_line + ["--file", settings_file.name])
         os.remove(settings_file.name)
     else:
@@ -396,7 +571,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
                 relation_cmd_line.append('{}='.format(key))
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
-        subprocess.check_call(relation_cmd_line)
+        _hook_tools.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
 
@@ -420,7 +595,7 @@ def relation_ids(reltype=None):
     if reltype is not None:
         relid_cmd_line.append(reltype)
         return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+            _hook_tools.check_output(relid_cmd_line).decode('UTF-8')) or []
     return []
 
 
@@ -432,7 +607,7 @@ def related_units(relid=None):
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
     return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+        _hook_tools.check_output(units_cmd_line).decode('UTF-8')) or []
 
 
 @cached
@@ -606,14 +781,14 @@ def open_port(port, protocol="TCP"):
     """Open a service network port"""
     _args = ['open-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _hook_tools.check_call(_args)
 
 
 def close_port(port, protocol="TCP"):
     """Close a service network port"""
     _args = ['close-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _hook_tools.check_call(_args)
 
 
 @cached
@@ -621,7 +796,7 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_hook_tools.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -645,7 +820,7 @@ def storage_get(attribute=None, storage_id=None):
     if attribute:
         _args.append(attribute)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_hook_tools.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -657,7 +832,7 @@ def storage_list(storage_name=None):
     if storage_name:
         _args.append(storage_name)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_hook_tools.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except OSError as e:
@@ -690,52 +865,207 @@ class Hooks(object):
         def config_changed():
             pass  # your code here
 
+        # register a hook which only runs when its inputs change
+        @hooks.hook("db-relation-changed", relation=['host', 'password'])
+        def db_changed():
+            pass  # your code here
+
         if __name__ == "__main__":
             # execute a hook based on the name the program is called by
             hooks.execute(sys.argv)
+
+    To also trace work done around the hook, such as status assessment,
+    run it all within :meth:`trace`::
+
+        with hooks.trace():
+            hooks.execute(sys.argv)
+            assess_status()
     """
 
+    INPUTS_KEY = 'hookenv.inputs'
+    TRACE_KEY = 'hookenv.trace'
+
     def __init__(self, config_save=None):
         super(Hooks, self).__init__()
         self._hooks = {}
+        self._inputs = {}
 
         # For unknown reasons, we allow the Hooks constructor to override
         # config().implicit_save.
         if config_save is not None:
             config().implicit_save = config_save
 
-    def register(self, name, function):
-        """Register a hook"""
+    def register(self, name, function, inputs=None):
+        """Register a hook
+
+        :param inputs: optional dict with ``config`` and/or ``relation``
+            lists naming the config options and remote relation settings
+            the hook depends on. See :meth:`hook`.
+        """
         self._hooks[name] = function
+        if inputs:
+            self._inputs[name] = inputs
+        else:
+            self._inputs.pop(name, None)
 
     def execute(self, args):
-        """Execute a registered hook based on args[0]"""
-        _run_atstart()
+        """Execute a registered hook based on args[0]
+
+        Hook tool invocations made while the hook runs are counted and
+        timed, unless already within :meth:`trace`.
+        """
         hook_name = os.path.basename(args[0])
+        with self.trace(hook_name):
+            self._execute(hook_name)
+
+    @contextlib.contextmanager
+    def trace(self, name=None):
+        """Count and time hook tool invocations made in the enclosed block.
+
+        The trace is recorded along with its outcome, ``ok`` or
+        ``failed``, when the block exits. Nested traces are folded into
+        the outermost one. See :class:`TracingHookTools`.
+        """
+        global _hook_tools
+        if isinstance(_hook_tools, TracingHookTools):
+            yield _hook_tools
+            return
+        name = name or hook_name()
+        tracer = TracingHookTools(_hook_tools)
+        _hook_tools = tracer
+        outcome = 'failed'
+        try:
+            yield tracer
+            outcome = 'ok'
+        except SystemExit as x:
+            if x.code is None or x.code == 0:
+                outcome = 'ok'
+            raise
+        finally:
+            _hook_tools = tracer.backend
+            self._record_trace(name, tracer, outcome)
+
+    def _execute(self, hook_name):
+        _run_atstart()
+        self._forget_inputs(hook_name)
         if hook_name in self._hooks:
+            fingerprint = None
+            if hook_name in self._inputs:
+                fingerprint = self._fingerprint(self._inputs[hook_name])
+                if fingerprint == self._recorded_fingerprint(hook_name):
+                    log("Inputs of hook {} unchanged - skipping.".format(
+                        hook_name), level=DEBUG)
+                    _run_atexit()
+                    return
             try:
                 self._hooks[hook_name]()
             except SystemExit as x:
                 if x.code is None or x.code == 0:
                     _run_atexit()
                 raise
+            if fingerprint is not None:
+                self._record_fingerprint(hook_name, fingerprint)
             _run_atexit()
         else:
             raise UnregisteredHookError(hook_name)
 
-    def hook(self, *hook_names):
-        """Decorator, registering them as hooks"""
+    def hook(self, *hook_names, **inputs):
+        """Decorator, registering them as hooks
+
+        The optional ``config`` and ``relation`` keyword arguments list
+        the config options and the remote unit's relation settings the
+        hook reads. When given, the hook is skipped if a fingerprint of
+        those inputs matches the one recorded the last time it completed
+        successfully for the same relation and remote unit.
+        """
+        unknown = set(inputs) - set(('config', 'relation'))
+        if unknown:
+            raise TypeError(
+                'Unknown hook inputs: {}'.format(', '.join(sorted(unknown))))
+
         def wrapper(decorated):
             for hook_name in hook_names:
-                self.register(hook_name, decorated)
+                self.register(hook_name, decorated, inputs)
             else:
-                self.register(decorated.__name__, decorated)
+                self.register(decorated.__name__, decorated, inputs)
                 if '_' in decorated.__name__:
                     self.register(
-                        decorated.__name__.replace('_', '-'), decorated)
+                        decorated.__name__.replace('_', '-'), decorated,
+                        inputs)
             return decorated
         return wrapper
 
+    def _fingerprint(self, inputs):
+        data = {}
+        if inputs.get('config'):
+            conf = config() or {}
+            data['config'] = dict(
+                (k, conf.get(k)) for k in inputs['config'])
+        if inputs.get('relation') and in_relation_hook():
+            settings = relation_get() or {}
+            data['relation'] = dict(
+                (k, settings.get(k)) for k in inputs['relation'])
+        serialized = json.dumps(data, sort_keys=True).encode('UTF-8')
+        return hashlib.sha1(serialized).hexdigest()
+
+    def _fingerprint_key(self, hook_name):
+        return '{}.{}.{}.{}'.format(self.INPUTS_KEY, hook_name,
+                                    relation_id() or '',
+                                    remote_unit() or '')
+
+    def _recorded_fingerprint(self, hook_name):
+        from charmhelpers.core import unitdata
+        return unitdata.kv().get(self._fingerprint_key(hook_name))
+
+    def _forget_inputs(self, hook_name):
+        """Drop the fingerprints recorded for a remote unit when it joins
+        or departs, or for all units of a broken relation, so a unit
+        coming back with the same settings is not skipped."""
+        if not self._inputs or not hook_name.endswith(
+                ('-relation-joined', '-relation-departed',
+                 '-relation-broken')):
+            return
+        rid = relation_id()
+        if not rid:
+            return
+        unit = None
+        if not hook_name.endswith('-relation-broken'):
+            unit = remote_unit() or ''
+        from charmhelpers.core import unitdata
+        db = unitdata.kv()
+        prefix = self.INPUTS_KEY + '.'
+        stale = {}
+        for key, value in db.getrange(prefix).items():
+            # <hook>.<relation id>.<remote unit>
+            parts = key[len(prefix):].split('.', 2)
+            if (value is not None and len(parts) == 3 and
+                    parts[1] == rid and unit in (None, parts[2])):
+                stale[key] = None
+        if stale:
+            db.update_isolated(stale)
+
+    def _record_trace(self, hook_name, tracer, outcome):
+        from charmhelpers.core import unitdata
+        summary = tracer.summary()
+        report = tracer.report()
+        report['outcome'] = outcome
+        log('Hook {} {}: {}'.format(hook_name, outcome, summary),
+            level=DEBUG)
+        if not unitdata.kv_configured():
+            return
+        try:
+            unitdata.kv().update_isolated(
+                {'{}.{}'.format(self.TRACE_KEY, hook_name): report})
+        except Exception as e:
+            # Never mask the outcome of the hook itself.
+            log('Failed to record trace of hook {}: {}'.format(hook_name, e),
+                level=WARNING)
+
+    def _record_fingerprint(self, hook_name, fingerprint):
+        from charmhelpers.core import unitdata
+        unitdata.kv().update_isolated(
+            {self._fingerprint_key(hook_name): fingerprint})
+
 
 def charm_dir():
     """Return the root directory of the current charm"""
@@ -749,7 +1079,7 @@ def action_get(key=None):
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    action_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    action_data = json.loads(_hook_tools.check_output(cmd).decode('UTF-8'))
     return action_data
 
 
@@ -758,14 +1088,14 @@ def action_set(values):
     cmd = ['action-set']
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _hook_tools.check_call(cmd)
 
 
 def action_fail(message):
     """Sets the action status to failed and sets the error message.
 
     The results set by action_set are preserved."""
-    subprocess.check_call(['action-fail', message])
+    _hook_tools.check_call(['action-fail', message])
 
 
 def action_name():
@@ -783,6 +1113,9 @@ def action_tag():
     return os.environ.get('JUJU_ACTION_TAG')
 
 
+STATUS_KEY = 'hookenv.status'
+
+
 def status_set(workload_state, message):
     """Set the workload state with a message
 
@@ -790,6 +1123,11 @@ def status_set(workload_state, message):
     to the user via juju status. If the status-set command is not found then
     assume this is juju < 1.23 and juju-log the message unstead.
 
+    The last published state and message are recorded in unitdata, and
+    identical updates are not sent again. status-get is only consulted
+    when there is no local record yet. Outside of a charm, where there is
+    no unitdata to record to, every update is sent.
+
     workload_state -- valid juju workload state.
     message        -- status update message
     """
@@ -798,10 +1136,17 @@ def status_set(workload_state, message):
         raise ValueError(
             '{!r} is not a valid workload state'.format(workload_state)
         )
+    from charmhelpers.core import unitdata
+    db = unitdata.kv() if unitdata.kv_configured() else None
+    current = [workload_state, message]
+    if db is not None and _status_published(db, current):
+        return
     cmd = ['status-set', workload_state, message]
     try:
-        ret = subprocess.call(cmd)
+        ret = _hook_tools.call(cmd)
         if ret == 0:
+            if db is not None:
+                db.update_isolated({STATUS_KEY: current})
             return
     except OSError as e:
         if e.errno != errno.ENOENT:
@@ -811,6 +1156,19 @@ def status_set(workload_state, message):
     log(log_message, level='INFO')
 
 
+def _status_published(db, status):
+    # Only asks status-get when nothing was recorded yet.
+    published = db.get(STATUS_KEY)
+    if published is None:
+        try:
+            published = list(status_get())
+        except CalledProcessError:
+            return False
+        if published == status:
+            db.update_isolated({STATUS_KEY: status})
+    return published == status
+
+
 def status_get():
     """Retrieve the previously set juju workload state and message
 
@@ -820,7 +1178,7 @@ def status_get():
     """
     cmd = ['status-get', "--format=json", "--include-data"]
     try:
-        raw_status = subprocess.check_output(cmd)
+        raw_status = _hook_tools.check_output(cmd)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return ('unknown', "")
@@ -852,14 +1210,14 @@ def is_leader():
     Uses juju to determine whether the current unit is the leader of its peers
     """
     cmd = ['is-leader', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_hook_tools.check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def leader_get(attribute=None):
     """Juju leader get value(s)"""
     cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_hook_tools.check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -875,7 +1233,7 @@ def leader_set(settings=None, **kwargs):
             cmd.append('{}='.format(k))
         else:
             cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _hook_tools.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -885,7 +1243,7 @@ def payload_register(ptype, klass, pid):
     cmd = ['payload-register']
     for x in [ptype, klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _hook_tools.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -897,7 +1255,7 @@ def payload_unregister(klass, pid):
     cmd = ['payload-unregister']
     for x in [klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _hook_tools.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -909,7 +1267,7 @@ def payload_status_set(klass, pid, status):
     cmd = ['payload-status-set']
     for x in [klass, pid, status]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _hook_tools.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -925,7 +1283,7 @@ def resource_get(name):
 
     cmd = ['resource-get', name]
     try:
-        return subprocess.check_output(cmd).decode('UTF-8')
+        return _hook_tools.check_output(cmd).decode('UTF-8')
     except subprocess.CalledProcessError:
         return False
 
@@ -1006,4 +1364,4 @@ def network_get_primary_address(binding):
     :raise: NotImplementedError if run on Juju < 2.0
     '''
     cmd = ['network-get', '--primary-address', binding]
-    return subprocess.check_output(cmd).strip()
+    return _hook_tools.check_output(cmd).strip()
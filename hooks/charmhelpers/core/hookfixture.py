@@ -0,0 +1,304 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory hook environment for tests and dry runs.
+
+A fixture is a plain dict (usually loaded from JSON) describing the hook
+context::
+
+    {
+        "unit": "lxd/0",
+        "hook": "lxd-relation-changed",
+        "relation_id": "lxd:1",
+        "remote_unit": "nova-compute/0",
+        "config": {"storage-type": "btrfs"},
+        "previous_config": {"storage-type": "lvm"},
+        "unit_data": {"private-address": "10.0.0.10"},
+        "relations": {
+            "lxd": {
+                "lxd:1": {
+                    "nova-compute/0": {"user": "nova"},
+                    "lxd/0": {}
+                }
+            }
+        },
+        "kv": {"lxd-password": "secret"},
+        "leader": true,
+        "leader_settings": {},
+        "status": ["maintenance", ""]
+    }
+
+All keys are optional. Within :func:`hook_fixture`, hookenv accessors
+are answered from the fixture without forking, relation-set, status-set,
+juju-log and leader-set update it in place, and :func:`unitdata.kv`
+returns an in-memory store seeded from ``kv``::
+
+    with hook_fixture(load_fixture('fixtures/relation-changed.json')) as t:
+        lxd_hooks.hooks.execute(['lxd-relation-changed'])
+        assert t.relation_settings('lxd:1')['nonce']
+"""
+
+import contextlib
+import copy
+import errno
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import yaml
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+__author__ = 'Charm Helpers Developers <juju@lists.ubuntu.com>'
+
+# Options which take a value on the hook tool command lines.
+_VALUE_OPTIONS = ('-r', '-l', '-s', '--file')
+
+
+def load_fixture(path):
+    """Load a hook fixture from a JSON file"""
+    with open(path) as f:
+        return json.load(f)
+
+
+class FixtureHookTools(object):
+    """Hook tool backend answering from an in-memory fixture.
+
+    Unknown hook tools raise ``OSError(ENOENT)``, as if they were not
+    installed. Every invocation is recorded in :attr:`calls`.
+    """
+
+    def __init__(self, fixture):
+        self.fixture = fixture
+        self.unit = fixture.get('unit', 'unit/0')
+        self.config = fixture.get('config', {})
+        self.unit_data = fixture.get('unit_data', {})
+        self.relations = fixture.setdefault('relations', {})
+        self.leader_settings = fixture.setdefault('leader_settings', {})
+        self.status = list(fixture.get('status', ['unknown', '']))
+        self.log = []
+        self.calls = []
+
+    def call(self, cmd, **kwargs):
+        return self._run(cmd, kwargs)[0]
+
+    def check_call(self, cmd, **kwargs):
+        rc, output = self._run(cmd, kwargs)
+        if rc:
+            raise subprocess.CalledProcessError(rc, cmd, output)
+        return 0
+
+    def check_output(self, cmd, **kwargs):
+        rc, output = self._run(cmd, kwargs)
+        if rc:
+            raise subprocess.CalledProcessError(rc, cmd, output)
+        if kwargs.get('universal_newlines'):
+            return output
+        return output.encode('UTF-8')
+
+    def relation_settings(self, rid, unit=None):
+        """Return the settings of unit (default: the local unit) on rid"""
+        for relids in self.relations.values():
+            if rid in relids:
+                return relids[rid].setdefault(unit or self.unit, {})
+        raise KeyError(rid)
+
+    def _run(self, cmd, kwargs):
+        self.calls.append(list(cmd))
+        handler = getattr(self, '_' + cmd[0].replace('-', '_'), None)
+        if handler is None:
+            raise OSError(errno.ENOENT, 'No such file or directory', cmd[0])
+        options, args = self._parse(cmd[1:])
+        result = handler(options, args)
+        if isinstance(result, tuple):
+            return result
+        return 0, result
+
+    def _parse(self, argv):
+        options = {}
+        args = []
+        argv = iter(argv)
+        for arg in argv:
+            if arg in _VALUE_OPTIONS:
+                options[arg] = next(argv)
+            elif arg.startswith('-') and arg != '-':
+                name, _, value = arg.partition('=')
+                options[name] = value or True
+            else:
+                args.append(arg)
+        return options, args
+
+    def _relation(self, rid):
+        rid = rid or os.environ.get('JUJU_RELATION_ID')
+        for relids in self.relations.values():
+            if rid in relids:
+                return relids[rid]
+        return None
+
+    def _config_get(self, options, args):
+        if args:
+            return json.dumps(self.config.get(args[0]))
+        return json.dumps(self.config)
+
+    def _relation_get(self, options, args):
+        units = self._relation(options.get('-r'))
+        if units is None:
+            return 2, ''
+        unit = args[1] if len(args) > 1 else os.environ.get(
+            'JUJU_REMOTE_UNIT')
+        settings = units.get(unit, {})
+        if not args or args[0] == '-':
+            return json.dumps(settings)
+        return json.dumps(settings.get(args[0]))
+
+    def _relation_set(self, options, args):
+        if '--help' in options:
+            return 'usage: relation-set [options] key=value [key=value ...]\n' \
+                '    --file  file containing key-value pairs\n'
+        units = self._relation(options.get('-r'))
+        if units is None:
+            return 2, ''
+        if '--file' in options:
+            with open(options['--file']) as f:
+                settings = yaml.safe_load(f) or {}
+        else:
+            settings = dict(a.split('=', 1) for a in args)
+        local = units.setdefault(self.unit, {})
+        for key, value in settings.items():
+            if value in (None, ''):
+                local.pop(key, None)
+            else:
+                local[key] = value
+        return ''
+
+    def _relation_ids(self, options, args):
+        reltype = args[0] if args else os.environ.get('JUJU_RELATION')
+        return json.dumps(sorted(self.relations.get(reltype, {})))
+
+    def _relation_list(self, options, args):
+        units = self._relation(options.get('-r')) or {}
+        return json.dumps(sorted(u for u in units if u != self.unit))
+
+    def _unit_get(self, options, args):
+        return json.dumps(self.unit_data.get(args[0]))
+
+    def _status_set(self, options, args):
+        self.status = [args[0], args[1] if len(args) > 1 else '']
+        return ''
+
+    def _status_get(self, options, args):
+        return json.dumps({'status': self.status[0],
+                           'message': self.status[1]})
+
+    def _juju_log(self, options, args):
+        self.log.append((options.get('-l'), args[-1]))
+        return ''
+
+    def _is_leader(self, options, args):
+        return json.dumps(bool(self.fixture.get('leader', False)))
+
+    def _leader_get(self, options, args):
+        if not args or args[0] == '-':
+            return json.dumps(self.leader_settings)
+        return json.dumps(self.leader_settings.get(args[0]))
+
+    def _leader_set(self, options, args):
+        for arg in args:
+            key, _, value = arg.partition('=')
+            if value:
+                self.leader_settings[key] = value
+            else:
+                self.leader_settings.pop(key, None)
+        return ''
+
+    def _open_port(self, options, args):
+        return ''
+
+    def _close_port(self, options, args):
+        return ''
+
+
+def _fixture_environ(fixture, charm_dir):
+    env = {
+        'JUJU_UNIT_NAME': fixture.get('unit', 'unit/0'),
+        'CHARM_DIR': charm_dir,
+    }
+    if fixture.get('hook'):
+        env['JUJU_HOOK_NAME'] = fixture['hook']
+    if fixture.get('relation_id'):
+        env['JUJU_RELATION_ID'] = fixture['relation_id']
+        env['JUJU_RELATION'] = fixture['relation_id'].split(':')[0]
+    if fixture.get('remote_unit'):
+        env['JUJU_REMOTE_UNIT'] = fixture['remote_unit']
+    return env
+
+
+@contextlib.contextmanager
+def hook_fixture(fixture):
+    """Run the enclosed block against an in-memory hook environment.
+
+    The fixture is deep-copied, so it can be reused across runs. Yields
+    the :class:`FixtureHookTools` backend; the original backend, unit
+    state store and environment are restored on exit.
+    """
+    fixture = copy.deepcopy(fixture)
+    tools = FixtureHookTools(fixture)
+    charm_dir = fixture.get('charm_dir')
+    cleanup_dir = charm_dir is None
+    if cleanup_dir:
+        charm_dir = tempfile.mkdtemp(prefix='hook-fixture-')
+    if 'previous_config' in fixture:
+        with open(os.path.join(charm_dir,
+                               hookenv.Config.CONFIG_FILE_NAME), 'w') as f:
+            json.dump(fixture['previous_config'], f)
+
+    env = _fixture_environ(fixture, charm_dir)
+    saved_env = dict((k, os.environ.get(k)) for k in
+                     ('JUJU_UNIT_NAME', 'CHARM_DIR', 'JUJU_HOOK_NAME',
+                      'JUJU_RELATION_ID', 'JUJU_RELATION',
+                      'JUJU_REMOTE_UNIT'))
+    for key in saved_env:
+        os.environ.pop(key, None)
+    os.environ.update(env)
+
+    db = unitdata.Storage(':memory:')
+    db.update(fixture.get('kv', {}))
+    db.flush()
+    saved_kv = unitdata._KV
+    unitdata._KV = db
+
+    saved_atstart = list(hookenv._atstart)
+    saved_atexit = list(hookenv._atexit)
+    previous = hookenv.set_hook_tools(tools)
+    try:
+        yield tools
+    finally:
+        hookenv.set_hook_tools(previous)
+        hookenv._atstart[:] = saved_atstart
+        hookenv._atexit[:] = saved_atexit
+        unitdata._KV = saved_kv
+        db.close()
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        if cleanup_dir:
+            shutil.rmtree(charm_dir, ignore_errors=True)
@@ -24,6 +24,8 @@
 import os
 import re
 import pwd
+import errno
+import stat
 import glob
 import grp
 import random
@@ -31,14 +33,20 @@ import string
 import subprocess
 import hashlib
 import functools
+import math
 import itertools
+import select
+import time
 from contextlib import contextmanager
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
 
 import six
 
+from . import hookenv
 from .hookenv import log
-from .fstab import Fstab
+from .fstab import Fstab, FstabEditor
+from . import unitdata
 
 
 def service_start(service_name):
@@ -128,10 +136,123 @@ def service(action, service_name):
     return subprocess.call(cmd) == 0
 
 
+def service_batch(action, service_names):
+    """Apply action to several system services.
+
+    On systemd this is a single systemctl call, which returns once all the
+    queued jobs have completed; if it fails, the services which were not
+    started, stopped or restarted as asked are retried on their own, so
+    one bad unit does not hold back the others.
+
+    :returns: True if the action succeeded for every service
+    """
+    service_names = list(service_names)
+    if not service_names:
+        return True
+    if init_is_systemd() and len(service_names) > 1:
+        before = None
+        if action in _SYSTEMD_RESTART_ACTIONS:
+            before = _active_since(service_names)
+        if subprocess.call(['systemctl', action] + service_names) == 0:
+            return True
+        service_names = _services_not_done(action, service_names, before)
+    results = [service(action, name) for name in service_names]
+    return all(results)
+
+
+# Whether each action leaves a systemd service running.
+_SYSTEMD_ACTION_RUNNING = {
+    'start': True,
+    'stop': False,
+}
+# Actions only known to be done once the service was (re)activated since.
+_SYSTEMD_RESTART_ACTIONS = ('restart', 'try-restart', 'reload-or-restart')
+
+
+def _active_since(service_names):
+    """Return {service: ActiveEnterTimestampMonotonic}, or None if
+    systemctl failed"""
+    try:
+        props = _service_properties(service_names,
+                                    ['ActiveEnterTimestampMonotonic'])
+    except subprocess.CalledProcessError:
+        return None
+    return dict((name, p.get('ActiveEnterTimestampMonotonic'))
+                for name, p in props.items())
+
+
+def _services_not_done(action, service_names, before=None):
+    if action in _SYSTEMD_RESTART_ACTIONS:
+        if before is None:
+            return service_names
+        try:
+            after = _service_properties(
+                service_names,
+                ['ActiveState', 'ActiveEnterTimestampMonotonic'])
+        except subprocess.CalledProcessError:
+            return service_names
+        return [name for name in service_names
+                if after.get(name, {}).get('ActiveState') not in
+                SYSTEMD_RUNNING_STATES or
+                after[name].get('ActiveEnterTimestampMonotonic') ==
+                before.get(name)]
+    running = _SYSTEMD_ACTION_RUNNING.get(action)
+    if running is None:
+        return service_names
+    try:
+        states = service_states(service_names)
+    except subprocess.CalledProcessError:
+        return service_names
+    return [name for name in service_names
+            if name not in states or
+            (states[name].active_state in SYSTEMD_RUNNING_STATES) !=
+            running]
+
+
+ServiceState = namedtuple('ServiceState',
+                          ['load_state', 'active_state', 'sub_state'])
+
+# systemd ActiveStates in which a service counts as running.
+SYSTEMD_RUNNING_STATES = ('active', 'reloading')
+
+
+def service_states(service_names):
+    """Query the state of several systemd services with one systemctl call.
+
+    :returns: dict of service name to :class:`ServiceState`, e.g.
+              ``ServiceState('loaded', 'active', 'running')``; services
+              which do not exist have a load_state of ``not-found``.
+    """
+    props = _service_properties(service_names,
+                                ['LoadState', 'ActiveState', 'SubState'])
+    return dict((name, ServiceState(p.get('LoadState'),
+                                    p.get('ActiveState'),
+                                    p.get('SubState')))
+                for name, p in props.items())
+
+
+def _service_properties(service_names, properties):
+    service_names = list(service_names)
+    if not service_names:
+        return {}
+    output = subprocess.check_output(
+        ['systemctl', 'show', '--property=' + ','.join(properties)] +
+        service_names).decode('UTF-8')
+    # One block of properties per unit, in argument order.
+    blocks = [dict(line.split('=', 1) for line in block.splitlines()
+                   if '=' in line)
+              for block in output.strip().split('\n\n')]
+    return dict(zip(service_names, blocks))
+
+
 def service_running(service_name):
     """Determine whether a system service is running"""
     if init_is_systemd():
-        return service('is-active', service_name)
+        try:
+            state = service_states([service_name])[service_name]
+        except (subprocess.CalledProcessError, KeyError):
+            return False
+        return state.active_state in SYSTEMD_RUNNING_STATES
     else:
         try:
             output = subprocess.check_output(
@@ -302,14 +423,40 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
         target.write(content)
 
 
+# FstabEditor of the active fstab_batch(), if any.
+_fstab_editor = None
+
+
+@contextmanager
+def fstab_batch():
+    """Collect /etc/fstab changes made within the block, by fstab_add,
+    fstab_remove or mount/umount with persist=True, into one atomic
+    rewrite when it exits. Nested batches join the outermost one.
+    """
+    global _fstab_editor
+    if _fstab_editor is not None:
+        yield _fstab_editor
+        return
+    _fstab_editor = FstabEditor()
+    try:
+        yield _fstab_editor
+    finally:
+        # Changes describe mounts which already happened, so write them
+        # even if the block failed part way.
+        editor, _fstab_editor = _fstab_editor, None
+        editor.commit()
+
+
 def fstab_remove(mp):
     """Remove the given mountpoint entry from /etc/fstab"""
-    return Fstab.remove_by_mountpoint(mp)
+    with fstab_batch() as fstab:
+        return fstab.remove_by_mountpoint(mp)
 
 
 def fstab_add(dev, mp, fs, options=None):
     """Adds the given device entry to the /etc/fstab file"""
-    return Fstab.add(dev, mp, fs, options=options)
+    with fstab_batch() as fstab:
+        return fstab.add_entry(Fstab.Entry(dev, mp, fs, options=options))
 
 
 def mount(device, mountpoint, options=None, persist=False, filesystem="ext3"):
@@ -323,6 +470,7 @@ def mount(device, mountpoint, options=None, persist=False, filesystem="ext3"):
     except subprocess.CalledProcessError as e:
         log('Error mounting {} at {}\n{}'.format(device, mountpoint, e.output))
         return False
+    _mount_table.invalidate()
 
     if persist:
         return fstab_add(device, mountpoint, filesystem, options=options)
@@ -337,19 +485,96 @@ def umount(mountpoint, persist=False):
     except subprocess.CalledProcessError as e:
         log('Error unmounting {}\n{}'.format(mountpoint, e.output))
         return False
+    _mount_table.invalidate()
 
     if persist:
         return fstab_remove(mountpoint)
     return True
 
 
+Mount = namedtuple('Mount', ['mountpoint', 'device', 'fstype', 'options'])
+
+
+def _unescape_mountinfo(field):
+    # Spaces, tabs, newlines and backslashes are escaped as octal.
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountTable(object):
+    """Mounts of this process's namespace, parsed from mountinfo.
+
+    The file is only re-read when poll() on it reports that the mount
+    table changed (or after :meth:`invalidate`), so lookups are usually
+    dict lookups. Where a mountpoint is mounted over, the topmost mount
+    wins.
+    """
+
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self, path=None):
+        self._path = path or self.PATH
+        self._file = None
+        self._poll = None
+        self._entries = None
+        self._by_mountpoint = {}
+
+    def invalidate(self):
+        self._entries = None
+
+    def _stale(self):
+        if self._entries is None or self._poll is None:
+            return True
+        return bool(self._poll.poll(0))
+
+    def _refresh(self):
+        if not self._stale():
+            return
+        if self._file is None:
+            self._file = open(self._path)
+            if hasattr(select, 'poll'):
+                self._poll = select.poll()
+                self._poll.register(self._file.fileno(),
+                                    select.POLLPRI | select.POLLERR)
+                # Clear any change pending from before the first read.
+                self._poll.poll(0)
+        self._file.seek(0)
+        entries = []
+        for line in self._file.read().splitlines():
+            fields = line.split()
+            # Optional fields are terminated by a single '-'.
+            sep = fields.index('-', 6)
+            entries.append(Mount(_unescape_mountinfo(fields[4]),
+                                 _unescape_mountinfo(fields[sep + 2]),
+                                 fields[sep + 1], fields[5]))
+        self._entries = entries
+        self._by_mountpoint = dict((m.mountpoint, m) for m in entries)
+
+    @property
+    def entries(self):
+        """All mounts, in mount order"""
+        self._refresh()
+        return list(self._entries)
+
+    def get(self, mountpoint):
+        """Return the :class:`Mount` at mountpoint, or None"""
+        self._refresh()
+        return self._by_mountpoint.get(mountpoint)
+
+    def __contains__(self, mountpoint):
+        return self.get(mountpoint) is not None
+
+
+_mount_table = MountTable()
+
+
+def mount_table():
+    """Return the process-wide :class:`MountTable`"""
+    return _mount_table
+
+
 def mounts():
     """Get a list of all mounted volumes as [[mountpoint,device],[...]]"""
-    with open('/proc/mounts') as f:
-        # [['/mount/point','/dev/path'],[...]]
-        system_mounts = [m[1::-1] for m in [l.strip().split()
-                                            for l in f.readlines()]]
-    return system_mounts
+    return [[m.mountpoint, m.device] for m in _mount_table.entries]
 
 
 def fstab_mount(mountpoint):
@@ -360,22 +585,61 @@ def fstab_mount(mountpoint):
     except subprocess.CalledProcessError as e:
         log('Error unmounting {}\n{}'.format(mountpoint, e.output))
         return False
+    _mount_table.invalidate()
     return True
 
 
+# Bytes read at a time when hashing files.
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Threads used to hash the files matching a path_hash() or
+# path_fingerprints() pattern.
+HASH_THREADS = 4
+
+# Files modified less than this many seconds ago are always hashed, as a
+# further change within the filesystem's timestamp granularity would not
+# show in their stat.
+RACY_MTIME_SECONDS = 2
+
+# unitdata key prefix for the file fingerprints used by restart_on_change.
+FINGERPRINTS_KEY = 'host.fingerprints.'
+
+
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
-    if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
-    else:
+    hashes = file_hashes(path, (hash_type,))
+    if hashes is None:
+        return None
+    return hashes[hash_type]
+
+
+def file_hashes(path, hash_types=('md5', 'sha256')):
+    """Hash the contents of 'path' with several algorithms in one pass.
+
+    The file is streamed through a fixed HASH_CHUNK_SIZE buffer, so memory
+    use does not grow with its size.
+
+    :param hash_types: Hash algorithms supported by :mod:`hashlib`
+    :return: dict: A { hash_type: hexdigest } dictionary, or None if the
+                   file is not found.
+    """
+    if not os.path.exists(path):
         return None
+    hashes = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types]
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', 0) as source:
+        while True:
+            size = source.readinto(buf)
+            if not size:
+                break
+            for _, h in hashes:
+                h.update(view[:size])
+    return dict((hash_type, h.hexdigest()) for hash_type, h in hashes)
 
 
 def path_hash(path):
@@ -386,10 +650,66 @@ def path_hash(path):
     :return: dict: A { filename: hash } dictionary for all matched files.
                    Empty if none found.
     """
-    return {
-        filename: file_hash(filename)
-        for filename in glob.iglob(path)
-    }
+    return _hash_files(list(glob.iglob(path)))
+
+
+def _hash_files(filenames):
+    if len(filenames) < 2:
+        return dict((filename, file_hash(filename)) for filename in filenames)
+    # hashlib releases the GIL while hashing, so threads overlap both the
+    # reads and the digests.
+    pool = ThreadPool(min(len(filenames), HASH_THREADS))
+    try:
+        return dict(zip(filenames, pool.map(file_hash, filenames)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _stat_fingerprint(path, previous=None):
+    # [size, mtime_ns, inode], plus the previous digest if it still holds.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    fingerprint = [st.st_size, mtime_ns, st.st_ino]
+    if (previous and list(previous[:3]) == fingerprint and
+            time.time() - st.st_mtime > RACY_MTIME_SECONDS):
+        fingerprint.append(previous[3])
+    return fingerprint
+
+
+def path_fingerprints(path, previous=None):
+    """Return a [size, mtime_ns, inode, md5] fingerprint of all files
+    matching 'path'.
+
+    A file is only hashed if its size, mtime or inode differ from the
+    previous fingerprint, or it was modified too recently to tell. Files
+    which need hashing are hashed in parallel, as by :func:`path_hash`.
+
+    :param dict previous: Earlier result for the same path, used to skip
+                          hashing files whose stat is unchanged.
+    :return: dict: A { filename: fingerprint } dictionary for all matched
+                   files. Empty if none found.
+    """
+    previous = previous or {}
+    fingerprints = {}
+    for filename in glob.iglob(path):
+        fingerprint = _stat_fingerprint(filename, previous.get(filename))
+        if fingerprint is not None:
+            fingerprints[filename] = fingerprint
+    stale = [filename for filename, fingerprint in fingerprints.items()
+             if len(fingerprint) == 3]
+    for filename, digest in _hash_files(stale).items():
+        fingerprints[filename].append(digest)
+    return fingerprints
+
+
+def _digests(fingerprints):
+    return dict((f, fp[3]) for f, fp in fingerprints.items())
 
 
 def check_hash(path, checksum, hash_type='md5'):
@@ -455,19 +775,27 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False):
     @param stopstart: whether to stop, start or restart a service
     @returns result of lambda_f()
     """
-    checksums = {path: path_hash(path) for path in restart_map}
+    # Fingerprints from the previous hook let the first pass get away
+    # with stat() for files which have not changed since.
+    db = unitdata.kv() if unitdata.kv_configured() else None
+    before = dict((path, path_fingerprints(
+        path, db.get(FINGERPRINTS_KEY + path) if db else None))
+        for path in restart_map)
     r = lambda_f()
+    after = dict((path, path_fingerprints(path, before[path]))
+                 for path in restart_map)
+    if db is not None:
+        db.update_isolated(after, prefix=FINGERPRINTS_KEY)
     # create a list of lists of the services to restart
     restarts = [restart_map[path]
                 for path in restart_map
-                if path_hash(path) != checksums[path]]
+                if _digests(after[path]) != _digests(before[path])]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
         actions = ('stop', 'start') if stopstart else ('restart',)
         for action in actions:
-            for service_name in services_list:
-                service(action, service_name)
+            service_batch(action, services_list)
     return r
 
 
@@ -481,33 +809,128 @@ def lsb_release():
     return d
 
 
+# Characters used by pwgen(): letters and digits, less vowels and those
+# easily mistaken for one another.
+PASSWORD_ALPHABET = ''.join(
+    l for l in (string.ascii_letters + string.digits)
+    if l not in 'l0QD1vAEIOUaeiou')
+
+
+def random_tokens(count, length=None, alphabet=PASSWORD_ALPHABET,
+                  entropy=None):
+    """Generate several random tokens from one read of os.urandom().
+
+    Bytes are mapped onto the alphabet by rejection sampling, so every
+    character is equally likely.
+
+    :param int count: Number of tokens to generate
+    :param int length: Characters per token
+    :param str alphabet: Characters to draw from, at most 256
+    :param int entropy: Instead of length, the minimum bits of entropy
+                        per token
+    :returns: list of str
+    """
+    size = len(alphabet)
+    if not 1 < size <= 256:
+        raise ValueError('Alphabet must have 2 to 256 characters')
+    if length is None:
+        if entropy is None:
+            raise ValueError('Either length or entropy is required')
+        length = int(math.ceil(entropy / math.log(size, 2)))
+    needed = count * length
+    # Bytes at or above limit would favour the start of the alphabet.
+    limit = 256 - 256 % size
+    chars = []
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        for b in bytearray(os.urandom(missing * 256 // limit + 16)):
+            if b < limit:
+                chars.append(alphabet[b % size])
+        del chars[needed:]
+    return [''.join(chars[i:i + length]) for i in range(0, needed, length)]
+
+
+def random_token(length=None, alphabet=PASSWORD_ALPHABET, entropy=None):
+    """Generate a random token, see :func:`random_tokens`."""
+    return random_tokens(1, length, alphabet, entropy)[0]
+
+
 def pwgen(length=None):
     """Generate a random pasword."""
     if length is None:
         # A random length is ok to use a weak PRNG
         length = random.choice(range(35, 45))
-    alphanumeric_chars = [
-        l for l in (string.ascii_letters + string.digits)
-        if l not in 'l0QD1vAEIOUaeiou']
-    # Use a crypto-friendly PRNG (e.g. /dev/urandom) for making the
-    # actual password
-    random_generator = random.SystemRandom()
-    random_chars = [
-        random_generator.choice(alphanumeric_chars) for _ in range(length)]
-    return(''.join(random_chars))
+    return random_token(length)
+
+
+SYS_NET = '/sys/class/net'
+
+# ARPHRD_ETHER, the sysfs link type of interfaces with a MAC address.
+ARPHRD_ETHER = '1'
+
+Nic = namedtuple('Nic', ['name', 'index', 'mtu', 'hwaddr', 'physical',
+                         'master', 'bond_master', 'bond', 'bridge'])
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _read_nic(name):
+    path = os.path.join(SYS_NET, name)
+    index = _read_sysfs(os.path.join(path, 'ifindex'))
+    if index is None:
+        # Removed while we were looking
+        return None
+    master = None
+    bond_master = None
+    master_path = os.path.join(path, 'master')
+    if os.path.exists(master_path):
+        master_path = os.path.realpath(master_path)
+        master = os.path.basename(master_path)
+        if os.path.exists(os.path.join(master_path, 'bonding')):
+            bond_master = master
+    hwaddr = ''
+    if _read_sysfs(os.path.join(path, 'type')) == ARPHRD_ETHER:
+        hwaddr = _read_sysfs(os.path.join(path, 'address')) or ''
+    return Nic(name=name,
+               index=int(index),
+               mtu=_read_sysfs(os.path.join(path, 'mtu')) or '',
+               hwaddr=hwaddr,
+               physical='/virtual/' not in os.path.realpath(path),
+               master=master,
+               bond_master=bond_master,
+               bond=os.path.isdir(os.path.join(path, 'bonding')),
+               bridge=os.path.isdir(os.path.join(path, 'bridge')))
+
+
+@hookenv.cached
+def nic_inventory():
+    """Return a { name: :class:`Nic` } dictionary of all network interfaces,
+    ordered by ifindex.
+
+    Read from sysfs once and cached for the rest of the hook; functions
+    changing interfaces here flush it. Empty if sysfs is not available.
+    """
+    nics = []
+    if os.path.isdir(SYS_NET):
+        for name in os.listdir(SYS_NET):
+            nic = _read_nic(name)
+            if nic is not None:
+                nics.append(nic)
+    return OrderedDict((nic.name, nic)
+                       for nic in sorted(nics, key=lambda nic: nic.index))
 
 
 def is_phy_iface(interface):
     """Returns True if interface is not virtual, otherwise False."""
     if interface:
-        sys_net = '/sys/class/net'
-        if os.path.isdir(sys_net):
-            for iface in glob.glob(os.path.join(sys_net, '*')):
-                if '/virtual/' in os.path.realpath(iface):
-                    continue
-
-                if interface == os.path.basename(iface):
-                    return True
+        nic = nic_inventory().get(interface)
+        return bool(nic and nic.physical)
 
     return False
 
@@ -518,17 +941,9 @@ def get_bond_master(interface):
     NOTE: the provided interface is expected to be physical
     """
     if interface:
-        iface_path = '/sys/class/net/%s' % (interface)
-        if os.path.exists(iface_path):
-            if '/virtual/' in os.path.realpath(iface_path):
-                return None
-
-            master = os.path.join(iface_path, 'master')
-            if os.path.exists(master):
-                master = os.path.realpath(master)
-                # make sure it is a bond master
-                if os.path.exists(os.path.join(master, 'bonding')):
-                    return os.path.basename(master)
+        nic = nic_inventory().get(interface)
+        if nic and nic.physical:
+            return nic.bond_master
 
     return None
 
@@ -540,6 +955,19 @@ def list_nics(nic_type=None):
     else:
         int_types = nic_type
 
+    inventory = nic_inventory()
+    if inventory:
+        if not nic_type:
+            return list(inventory)
+        # Grouped by type in the order given, as when asking ip for one
+        # type at a time.
+        interfaces = []
+        for int_type in int_types:
+            for iface in inventory:
+                if iface.startswith(int_type) and iface not in interfaces:
+                    interfaces.append(iface)
+        return interfaces
+
     interfaces = []
     if nic_type:
         for int_type in int_types:
@@ -578,11 +1006,88 @@ def list_nics(nic_type=None):
 def set_nic_mtu(nic, mtu):
     """Set the Maximum Transmission Unit (MTU) on a network interface."""
     cmd = ['ip', 'link', 'set', nic, 'mtu', mtu]
-    subprocess.check_call(cmd)
+    try:
+        subprocess.check_call(cmd)
+    finally:
+        hookenv.flush('nic_inventory')
+
+
+class NicMtuError(ValueError):
+    """MTU changes could not be applied; any that were have been reverted"""
+    pass
+
+
+def _nic_depth(nic, inventory):
+    depth = 0
+    seen = set()
+    while nic in inventory and inventory[nic].master and nic not in seen:
+        seen.add(nic)
+        nic = inventory[nic].master
+        depth += 1
+    return depth
+
+
+def _ip_batch(commands, force=False):
+    cmd = ['ip'] + (['-force'] if force else []) + ['-batch', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate(''.join(commands).encode('UTF-8'))[0]
+    return proc.returncode, output.decode('UTF-8')
+
+
+def set_nic_mtus(mtus):
+    """Set the MTU of several network interfaces with one ``ip -batch``.
+
+    Increases are applied to slaves before their bond or bridge masters
+    and decreases the other way round, so every intermediate state is
+    valid. The result is checked in sysfs; on any failure the interfaces
+    already changed are set back to their previous MTU.
+
+    :param dict mtus: { nic: mtu }
+    :raises NicMtuError: If the changes could not be applied
+    """
+    inventory = nic_inventory()
+    previous = dict((nic, inventory[nic].mtu if nic in inventory else '')
+                    for nic in mtus)
+    changes = [(nic, str(mtu)) for nic, mtu in mtus.items()
+               if str(mtu) != previous[nic]]
+    if not changes:
+        return
+    increases = [c for c in changes if not previous[c[0]] or
+                 int(c[1]) > int(previous[c[0]])]
+    decreases = [c for c in changes if c not in increases]
+    increases.sort(key=lambda c: -_nic_depth(c[0], inventory))
+    decreases.sort(key=lambda c: _nic_depth(c[0], inventory))
+    ordered = increases + decreases
+
+    log('Setting MTU: {}'.format(
+        ', '.join('{}={}'.format(nic, mtu) for nic, mtu in ordered)))
+    try:
+        rc, output = _ip_batch(['link set dev {} mtu {}\n'.format(nic, mtu)
+                                for nic, mtu in ordered])
+    finally:
+        hookenv.flush('nic_inventory')
+    failed = [nic for nic, mtu in ordered
+              if _read_sysfs(os.path.join(SYS_NET, nic, 'mtu')) != mtu]
+    if not rc and not failed:
+        return
+
+    rollback = [(nic, previous[nic]) for nic, _ in reversed(ordered)
+                if previous[nic] and
+                _read_sysfs(os.path.join(SYS_NET, nic, 'mtu')) !=
+                previous[nic]]
+    if rollback:
+        _ip_batch(['link set dev {} mtu {}\n'.format(nic, mtu)
+                   for nic, mtu in rollback], force=True)
+        hookenv.flush('nic_inventory')
+    raise NicMtuError('Failed to set MTU on {}: {}'.format(
+        ', '.join(failed) or 'all', output.strip()))
 
 
 def get_nic_mtu(nic):
     """Return the Maximum Transmission Unit (MTU) for a network interface."""
+    if nic in nic_inventory():
+        return nic_inventory()[nic].mtu
     cmd = ['ip', 'addr', 'show', nic]
     ip_output = subprocess.check_output(cmd).decode('UTF-8').split('\n')
     mtu = ""
@@ -595,6 +1100,8 @@ def get_nic_mtu(nic):
 
 def get_nic_hwaddr(nic):
     """Return the Media Access Control (MAC) for a network interface."""
+    if nic in nic_inventory():
+        return nic_inventory()[nic].hwaddr
     cmd = ['ip', '-o', '-0', 'addr', 'show', nic]
     ip_output = subprocess.check_output(cmd).decode('UTF-8')
     hwaddr = ""
@@ -650,21 +1157,80 @@ def chownr(path, owner, group, follow_links=True, chowntopdir=False):
     """
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(group).gr_gid
+
+    if chowntopdir:
+        _chown_changed(path, uid, gid, follow_links)
+    if getattr(os, 'scandir', None) in getattr(os, 'supports_fd', ()):
+        _chownr_fd(path, uid, gid, follow_links)
+    else:
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                _chown_changed(os.path.join(root, name), uid, gid,
+                               follow_links)
+
+
+# Threads changing ownership in different directories in chownr().
+CHOWN_THREADS = 8
+
+
+def _chown_changed(path, uid, gid, follow_links, dir_fd=None):
+    """chown path unless it already has the right ownership. Broken
+    symlinks are skipped."""
+    kwargs = {} if dir_fd is None else {'dir_fd': dir_fd}
+    try:
+        if follow_links:
+            st = os.stat(path, **kwargs)
+        else:
+            st = os.lstat(path, **kwargs)
+            if stat.S_ISLNK(st.st_mode):
+                os.stat(path, **kwargs)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if st.st_uid == uid and st.st_gid == gid:
+        return
     if follow_links:
-        chown = os.chown
+        os.chown(path, uid, gid, **kwargs)
+    elif dir_fd is None:
+        os.lchown(path, uid, gid)
     else:
-        chown = os.lchown
+        os.chown(path, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
 
-    if chowntopdir:
-        broken_symlink = os.path.lexists(path) and not os.path.exists(path)
-        if not broken_symlink:
-            chown(path, uid, gid)
-    for root, dirs, files in os.walk(path):
-        for name in dirs + files:
-            full = os.path.join(root, name)
-            broken_symlink = os.path.lexists(full) and not os.path.exists(full)
-            if not broken_symlink:
-                chown(full, uid, gid)
+
+def _chown_dir(path, uid, gid, follow_links):
+    """chown the entries of one directory, returning its subdirectories"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    subdirs = []
+    try:
+        for entry in os.scandir(fd):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(os.path.join(path, entry.name))
+            _chown_changed(entry.name, uid, gid, follow_links, dir_fd=fd)
+    finally:
+        os.close(fd)
+    return subdirs
+
+
+def _chownr_fd(path, uid, gid, follow_links):
+    # Walk the tree a level at a time, spreading each level's directories
+    # over a thread pool once there is more than one.
+    frontier = [path]
+    pool = None
+    try:
+        while frontier:
+            if len(frontier) == 1:
+                results = [_chown_dir(frontier[0], uid, gid, follow_links)]
+            else:
+                if pool is None:
+                    pool = ThreadPool(CHOWN_THREADS)
+                results = pool.map(
+                    lambda d: _chown_dir(d, uid, gid, follow_links), frontier)
+            frontier = list(itertools.chain(*results))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def lchownr(path, owner, group):
@@ -149,18 +149,62 @@ associated to the hookname.
 
 """
 
+import atexit
 import collections
 import contextlib
 import datetime
 import itertools
 import json
+import marshal
 import os
 import pprint
+import random
 import sqlite3
 import sys
+import time
+import zlib
+
+import six
+from six.moves.urllib.parse import quote
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Lowest SQLITE_MAX_VARIABLE_NUMBER of supported SQLite versions.
+MAX_VARIABLES = 999
+
+# Number of hook executions whose revision history HookData retains.
+KEEP_HOOKS = 100
+
+# Seconds to wait for a lock held by another connection, e.g. a juju
+# action running alongside a hook, before giving up.
+BUSY_TIMEOUT = 30.0
+
+# Statements still failing with SQLITE_BUSY after the timeout (or
+# immediately, when SQLite detects a lock upgrade deadlock) are retried
+# this many times with exponential backoff starting at BUSY_BACKOFF.
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.1
+
+# Values written by the binary codecs are stored as BLOBs starting with
+# one of these tags; TEXT values are always plain JSON.
+_TAG_JSON = b'j'
+_TAG_MARSHAL = b'm'
+_TAG_MSGPACK = b'p'
+_TAG_ZLIB = b'z'
+
+# marshal format readable by both Python 2 and Python 3.
+MARSHAL_VERSION = 2
+
+if six.PY3:
+    _BLOB_TYPES = (bytes, memoryview)
+else:
+    _BLOB_TYPES = (buffer,)  # noqa: F821
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -169,8 +213,50 @@ class Storage(object):
 
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
+
+    Large or structured values can instead be stored with a binary codec,
+    ``marshal`` (which also preserves bytes and tuples) or ``msgpack``
+    (when installed), optionally zlib compressed. Values are readable
+    whatever codec wrote them, so existing databases keep working after
+    switching codec; :meth:`migrate` rewrites them with the new one.
+
+    For write heavy workloads the SQLite journal can be tuned, e.g.
+    ``Storage(journal_mode='wal', synchronous='normal')`` trades a
+    little durability on power loss for far fewer fsyncs per commit.
+
+    :param str journal_mode: Optional SQLite journal mode, one of
+        :attr:`JOURNAL_MODES`.
+    :param str synchronous: Optional SQLite synchronous level, one of
+        :attr:`SYNCHRONOUS_LEVELS`.
+    :param bool cache: Load the whole kv table into memory when opened,
+        serve :meth:`get` from memory and write modified keys back on
+        :meth:`flush`. Writes are still discarded by ``flush(False)``.
+        Only use this when no other process writes to the database while
+        it is open.
+    :param str codec: Value codec, one of :attr:`CODECS`.
+    :param int compress_threshold: Optionally zlib compress encoded values
+        of at least this many bytes.
+    :param float timeout: Seconds to wait for locks held by other
+        connections; statements still busy are retried with backoff.
+    :param bool readonly: Open an existing database without ever taking
+        a write lock, for tools reading charm state while hooks run.
+        Pair with a writer using ``journal_mode='wal'`` so reads are not
+        blocked by hook transactions either.
     """
-    def __init__(self, path=None):
+
+    JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal')
+    SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+    CODECS = ('json', 'marshal', 'msgpack')
+
+    def __init__(self, path=None, journal_mode=None, synchronous=None,
+                 cache=False, codec='json', compress_threshold=None,
+                 timeout=BUSY_TIMEOUT, readonly=False):
+        if codec not in self.CODECS:
+            raise ValueError('Invalid codec: %s' % codec)
+        if codec == 'msgpack' and msgpack is None:
+            raise ValueError('The msgpack codec requires python-msgpack')
+        self.codec = codec
+        self.compress_threshold = compress_threshold
         self.db_path = path
         if path is None:
             if 'UNIT_STATE_DB' in os.environ:
@@ -178,11 +264,32 @@ class Storage(object):
             else:
                 self.db_path = os.path.join(
                     os.environ.get('CHARM_DIR', ''), '.unit-state.db')
-        self.conn = sqlite3.connect('%s' % self.db_path)
-        self.cursor = self.conn.cursor()
+        self.readonly = readonly
+        if readonly and six.PY3:
+            self.conn = sqlite3.connect(
+                'file:%s?mode=ro' % quote(os.path.abspath(self.db_path)),
+                timeout=timeout, uri=True)
+        else:
+            self.conn = sqlite3.connect('%s' % self.db_path, timeout=timeout)
+        self.cursor = self.conn.cursor(_RetryingCursor)
         self.revision = None
         self._closed = False
-        self._init()
+        if not readonly:
+            # Must precede the journal mode, which writes the header of a
+            # new database; existing databases are converted by compact().
+            self.cursor.execute('pragma auto_vacuum=incremental')
+        self._configure(journal_mode, synchronous)
+        if readonly:
+            self._init_readonly()
+        else:
+            self._init()
+        self._cache = None
+        self._decoded = {}
+        self._dirty = {}
+        self._isolated = {}
+        self._committed_changes = self.conn.total_changes
+        if cache:
+            self._load_cache()
 
     def close(self):
         if self._closed:
@@ -193,13 +300,29 @@ class Storage(object):
         self._closed = True
 
     def get(self, key, default=None, record=False):
+        if self._cache is not None:
+            return self._get_cached(key, default, record)
         self.cursor.execute('select data from kv where key=?', [key])
         result = self.cursor.fetchone()
         if not result:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(_decode(result[0]))
+        return _decode(result[0])
+
+    def _get_cached(self, key, default, record):
+        if key in self._decoded:
+            return self._decoded[key]
+        serialized = self._cache.get(key)
+        if serialized is None:
+            return default
+        value = _decode(serialized)
+        if record:
+            return Record(value)
+        if not isinstance(value, (dict, list)):
+            # Immutable values can be shared between callers.
+            self._decoded[key] = value
+        return value
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -211,37 +334,98 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
+        self._write_back()
+        clause, params = _prefix_clause(key_prefix)
+        self.cursor.execute(
+            "select key, data from kv where %s" % clause, params)
         result = self.cursor.fetchall()
 
-        if not result:
-            return {}
         if not strip:
             key_prefix = ''
         return dict([
-            (k[len(key_prefix):], json.loads(v)) for k, v in result])
+            (k[len(key_prefix):], _decode(v)) for k, v in result])
 
     def update(self, mapping, prefix=""):
         """
         Set the values of multiple keys at once.
 
+        Unchanged values are skipped, and the remaining rows are written
+        with a single batched statement per table.
+
         :param dict mapping: Mapping of keys to values
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        items = [("%s%s" % (prefix, k), self._encode(v))
+                 for k, v in mapping.items()]
+        if not items:
+            return
+        if self._cache is not None:
+            for k, v in items:
+                self._set_cached(k, v)
+            return
+        existing = {}
+        for chunk in _chunks([k for k, _ in items], MAX_VARIABLES):
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            existing.update(self.cursor.fetchall())
+        changed = [(k, v) for k, v in items if existing.get(k) != v]
+        if not changed:
+            return
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)', changed)
+        if self.revision:
+            self.cursor.executemany(
+                '''insert or replace into kv_revisions (
+                key, revision, data) values (?, ?, ?)''',
+                [(k, self.revision, v) for k, v in changed])
+
+    def update_isolated(self, mapping, prefix=""):
+        """
+        Set the values of multiple keys without committing or discarding
+        any other pending change.
+
+        Meant for bookkeeping written mid-hook, such as the last status
+        set. The values are committed straight away when nothing else is
+        pending; otherwise with the pending changes on :meth:`flush`, or
+        on their own if those are discarded or never flushed. Within
+        :meth:`hook_scope` they are committed or discarded with the hook.
+
+        :param dict mapping: Mapping of keys to values
+        :param str prefix: Optional prefix to apply to all keys in `mapping`
+            before setting
+        """
+        pending = self._dirty or (
+            self.conn.total_changes != self._committed_changes)
+        self.update(mapping, prefix)
+        if self.revision:
+            return
+        if not pending:
+            self.flush()
+            return
+        if not self._isolated:
+            atexit.register(self._flush_isolated)
+        self._isolated.update(
+            ("%s%s" % (prefix, k), v) for k, v in mapping.items())
+
+    def _flush_isolated(self):
+        # Commits values set by update_isolated() which are still pending
+        # at exit, discarding the changes nobody flushed.
+        if self._isolated and not self._closed:
+            self.flush(False)
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
+        self._write_back()
+        self._uncache([key])
         self.cursor.execute('delete from kv where key=?', [key])
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
-                [key, self.revision, json.dumps('DELETED')])
+                [key, self.revision, self._encode('DELETED')])
 
     def unsetrange(self, keys=None, prefix=""):
         """
@@ -252,20 +436,25 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        self._write_back()
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
+            self._uncache(keys)
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
-                    list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
+                    list(itertools.chain.from_iterable((key, self.revision, self._encode('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            if self._cache is not None:
+                self._uncache([k for k in self._cache
+                               if k.startswith(prefix)])
+            clause, params = _prefix_clause(prefix)
+            self.cursor.execute('delete from kv where %s' % clause, params)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
-                    ['%s%%' % prefix, self.revision, json.dumps('DELETED')])
+                    ['%s%%' % prefix, self.revision, self._encode('DELETED')])
 
     def set(self, key, value):
         """
@@ -274,78 +463,168 @@ class Storage(object):
         :param str key: Key to set the value for
         :param value: Any JSON-serializable value to be set
         """
-        serialized = json.dumps(value)
-
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
-        # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
+        serialized = self._encode(value)
+        if self._cache is not None:
+            self._set_cached(key, serialized)
+            return value
 
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        # Upsert, skipping mutations to the same value
+        self.cursor.execute(
+            '''insert or replace into kv (key, data)
+            select ?, ? where not exists (
+                select 1 from kv where key = ? and data = ?)''',
+            [key, serialized, key, serialized])
+        if not self.cursor.rowcount:
+            return value
 
         # Save
         if not self.revision:
             return value
 
         self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
+            '''insert or replace into kv_revisions (
+            key, revision, data) values (?, ?, ?)''',
+            [key, self.revision, serialized])
 
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
+        return value
+
+    def _encode(self, value):
+        if self.codec == 'json':
+            data = json.dumps(value)
+            if (self.compress_threshold is None or
+                    len(data) < self.compress_threshold):
+                return data
+            data = _TAG_JSON + data.encode('UTF-8')
+        elif self.codec == 'marshal':
+            data = _TAG_MARSHAL + marshal.dumps(value, MARSHAL_VERSION)
         else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+            data = _TAG_MSGPACK + msgpack.packb(value, use_bin_type=True)
+        if (self.compress_threshold is not None and
+                len(data) >= self.compress_threshold):
+            data = _TAG_ZLIB + zlib.compress(data)
+        return sqlite3.Binary(data)
 
-        return value
+    def migrate(self):
+        """Rewrite all stored values, including history, with this
+        Storage's codec and commit.
 
-    def delta(self, mapping, prefix):
+        :return int: Number of rows rewritten
         """
-        return a delta containing values that have changed.
+        self._write_back()
+        self.cursor.execute('select data, key from kv')
+        rows = self._reencode(self.cursor.fetchall())
+        self.cursor.executemany(
+            'update kv set data = ? where key = ?', rows)
+        count = len(rows)
+        self.cursor.execute('select data, key, revision from kv_revisions')
+        rows = self._reencode(self.cursor.fetchall())
+        self.cursor.executemany(
+            'update kv_revisions set data = ? where key = ? and revision = ?',
+            rows)
+        count += len(rows)
+        self._commit()
+        if self._cache is not None:
+            self._load_cache()
+        return count
+
+    def _reencode(self, rows):
+        result = []
+        for row in rows:
+            data = self._encode(_decode(row[0]))
+            if data != row[0]:
+                result.append((data,) + tuple(row[1:]))
+        return result
+
+    def _load_cache(self):
+        self.cursor.execute('select key, data from kv')
+        self._cache = dict(self.cursor.fetchall())
+        self._decoded.clear()
+        self._dirty.clear()
+
+    def _set_cached(self, key, serialized):
+        # Skip mutations to the same value
+        if self._cache.get(key) == serialized:
+            return
+        self._cache[key] = serialized
+        self._decoded.pop(key, None)
+        self._dirty[key] = (serialized, self.revision)
+
+    def _uncache(self, keys):
+        if self._cache is None:
+            return
+        for key in keys:
+            self._cache.pop(key, None)
+            self._decoded.pop(key, None)
+
+    def _write_back(self):
+        """Write modified cached keys to the database, within the current
+        transaction."""
+        if not self._dirty:
+            return
+        dirty = sorted(self._dirty.items())
+        self._dirty.clear()
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)',
+            [(k, v) for k, (v, _) in dirty])
+        revisions = [(k, r, v) for k, (v, r) in dirty if r]
+        if revisions:
+            self.cursor.executemany(
+                '''insert or replace into kv_revisions (
+                key, revision, data) values (?, ?, ?)''', revisions)
+
+    def delta(self, mapping, prefix, apply=False):
         """
-        previous = self.getrange(prefix, strip=True)
-        if not previous:
-            pk = set()
-        else:
-            pk = set(previous.keys())
-        ck = set(mapping.keys())
-        delta = DeltaSet()
+        return a delta containing values that have changed.
 
-        # added
-        for k in ck.difference(pk):
-            delta[k] = Delta(None, mapping[k])
+        Serialized values are compared in SQL, so only keys whose JSON
+        differs are decoded and compared in Python.
 
-        # removed
-        for k in pk.difference(ck):
-            delta[k] = Delta(previous[k], None)
+        :param dict mapping: Current values, keyed without ``prefix``
+        :param str prefix: Common prefix of the stored keys
+        :param bool apply: Also store ``mapping`` under ``prefix``, removing
+            keys no longer present, in the current transaction
+        """
+        self._write_back()
+        keys = dict(('%s%s' % (prefix, k), k) for k in mapping)
+        self.cursor.execute('delete from temp.kv_delta')
+        self.cursor.executemany(
+            'insert into temp.kv_delta (key, data) values (?, ?)',
+            [(key, self._encode(mapping[k])) for key, k in keys.items()])
+        delta = DeltaSet()
 
-        # changed
-        for k in pk.intersection(ck):
+        # added and changed
+        self.cursor.execute('''
+            select d.key, kv.data from temp.kv_delta d
+            left join kv on kv.key = d.key
+            where kv.data is null or kv.data != d.data''')
+        for key, data in self.cursor.fetchall():
+            k = keys[key]
             c = mapping[k]
-            p = previous[k]
+            if data is None:
+                delta[k] = Delta(None, c)
+                continue
+            p = _decode(data)
             if c != p:
                 delta[k] = Delta(p, c)
 
+        # removed
+        clause, params = _prefix_clause(prefix)
+        self.cursor.execute(
+            '''select key, data from kv where %s
+            and key not in (select key from temp.kv_delta)''' % clause,
+            params)
+        removed = self.cursor.fetchall()
+        for key, data in removed:
+            delta[key[len(prefix):]] = Delta(_decode(data), None)
+
+        self.cursor.execute('delete from temp.kv_delta')
+        if apply:
+            self.update(dict((k, mapping[k]) for k in delta if k in mapping),
+                        prefix=prefix)
+            # unsetrange() binds three variables per key for the history.
+            for chunk in _chunks([key for key, _ in removed],
+                                 MAX_VARIABLES // 3):
+                self.unsetrange(chunk)
         return delta
 
     @contextlib.contextmanager
@@ -370,11 +649,52 @@ class Storage(object):
 
     def flush(self, save=True):
         if save:
-            self.conn.commit()
+            self._write_back()
+            self._commit()
         elif self._closed:
             return
         else:
             self.conn.rollback()
+            self._committed_changes = self.conn.total_changes
+            if self._cache is not None:
+                self._load_cache()
+            if self._isolated:
+                self._save_isolated()
+        self._isolated.clear()
+
+    def _save_isolated(self):
+        # Outside of any hook revision, which may just have been rolled
+        # back.
+        isolated, self._isolated = self._isolated, {}
+        revision, self.revision = self.revision, None
+        try:
+            self.update(isolated)
+            self.flush()
+        finally:
+            self.revision = revision
+
+    def _configure(self, journal_mode, synchronous):
+        if journal_mode is not None:
+            if journal_mode.lower() not in self.JOURNAL_MODES:
+                raise ValueError(
+                    'Invalid journal mode: {!r}'.format(journal_mode))
+            self.cursor.execute('pragma journal_mode=%s' % journal_mode)
+        if synchronous is not None:
+            if str(synchronous).lower() not in self.SYNCHRONOUS_LEVELS:
+                raise ValueError(
+                    'Invalid synchronous level: {!r}'.format(synchronous))
+            self.cursor.execute('pragma synchronous=%s' % synchronous)
+
+    def _commit(self):
+        _retry_busy(self.conn.commit)
+        self._committed_changes = self.conn.total_changes
+
+    def _init_readonly(self):
+        self._init_scratch()
+        if not six.PY3:
+            # No URI filenames on Python 2; this also rules out writing
+            # to the scratch table, so delta() is unavailable.
+            self.cursor.execute('pragma query_only=1')
 
     def _init(self):
         self.cursor.execute('''
@@ -396,9 +716,85 @@ class Storage(object):
                hook text,
                date text
                )''')
-        self.conn.commit()
+        self.cursor.execute('''
+            create index if not exists kv_revisions_revision
+            on kv_revisions (revision)''')
+        self._init_scratch()
+        self._commit()
+
+    def _init_scratch(self):
+        # Scratch space for delta(), private to this connection.
+        self.cursor.execute('''
+            create temp table if not exists kv_delta (
+               key text,
+               data text,
+               primary key (key)
+               )''')
+
+    def compact(self, keep=None, max_age=None, vacuum_pages=None):
+        """Prune revision history and release the freed space.
+
+        History recorded by hooks that are neither among the last ``keep``
+        hooks nor younger than ``max_age`` is deleted. Current values in
+        the kv table are never touched.
+
+        :param int keep: Number of most recent hook executions to keep.
+        :param max_age: Keep hook executions younger than this, either a
+            :class:`datetime.timedelta` or a number of seconds.
+        :param int vacuum_pages: Maximum number of free pages to return
+            to the filesystem; all of them if ``None``.
+        """
+        assert not self.revision
+        self._write_back()
+        # The oldest hook version each policy wants to keep; history is
+        # kept if either policy wants it.
+        oldest = []
+        if keep is not None:
+            self.cursor.execute(
+                'select version from hooks order by version desc '
+                'limit 1 offset ?', [max(keep, 1) - 1])
+            row = self.cursor.fetchone()
+            # Fewer than keep hooks recorded: nothing to prune.
+            oldest.append(row[0] if row else 0)
+        if max_age is not None:
+            if not isinstance(max_age, datetime.timedelta):
+                max_age = datetime.timedelta(seconds=max_age)
+            cutoff = (datetime.datetime.utcnow() - max_age).isoformat()
+            self.cursor.execute(
+                'select min(version), (select max(version) + 1 from hooks) '
+                'from hooks where date >= ?', [cutoff])
+            youngest, after_last = self.cursor.fetchone()
+            oldest.append(youngest or after_last or 0)
+        if oldest and min(oldest):
+            version = min(oldest)
+            self.cursor.execute(
+                'delete from kv_revisions where revision < ?', [version])
+            self.cursor.execute(
+                'delete from hooks where version < ?', [version])
+        self._commit()
+        self._vacuum(vacuum_pages)
+
+    def _vacuum(self, pages=None):
+        self.cursor.execute('pragma auto_vacuum')
+        if self.cursor.fetchone()[0] != 2:
+            # Switching an existing database to incremental auto vacuum
+            # needs a one-off full vacuum.
+            self.cursor.execute('pragma auto_vacuum=incremental')
+            self.cursor.execute('vacuum')
+            return
+        self.cursor.execute('pragma freelist_count')
+        if not self.cursor.fetchone()[0]:
+            return
+        # execute() only steps the pragma once, freeing a single page;
+        # executescript() runs it to completion.
+        if pages is None:
+            self.cursor.executescript('pragma incremental_vacuum;')
+        else:
+            self.cursor.executescript(
+                'pragma incremental_vacuum(%d);' % pages)
 
     def gethistory(self, key, deserialize=False):
+        self._write_back()
         self.cursor.execute(
             '''
             select kv.revision, kv.key, kv.data, h.hook, h.date
@@ -406,20 +802,95 @@ class Storage(object):
                  hooks h
             where kv.key=?
              and kv.revision = h.version
+            order by kv.revision
             ''', [key])
         if deserialize is False:
             return self.cursor.fetchall()
         return map(_parse_history, self.cursor.fetchall())
 
     def debug(self, fh=sys.stderr):
+        self._write_back()
         self.cursor.execute('select * from kv')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
         self.cursor.execute('select * from kv_revisions')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
 
 
+def _prefix_clause(prefix):
+    """Return a where clause and parameters matching keys starting with
+    prefix, as a range the primary key index can serve.
+
+    A ``like`` pattern can't use the index, since SQLite's default
+    ``like`` is case insensitive.
+    """
+    if isinstance(prefix, six.binary_type):
+        prefix = prefix.decode('UTF-8')
+    # The upper bound is the prefix with its last character incremented;
+    # characters which can't be incremented are dropped first.
+    end = prefix.rstrip(six.unichr(sys.maxunicode))
+    if not end:
+        return 'key >= ?', [prefix]
+    return 'key >= ? and key < ?', [
+        prefix, end[:-1] + six.unichr(ord(end[-1]) + 1)]
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def _retry_busy(func, *args):
+    delay = BUSY_BACKOFF
+    for _ in range(BUSY_RETRIES):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+        time.sleep(delay + random.uniform(0, delay))
+        delay *= 2
+    return func(*args)
+
+
+class _RetryingCursor(sqlite3.Cursor):
+    """Cursor retrying statements which fail on another connection's lock"""
+
+    def execute(self, *args):
+        return _retry_busy(super(_RetryingCursor, self).execute, *args)
+
+    def executemany(self, *args):
+        return _retry_busy(super(_RetryingCursor, self).executemany, *args)
+
+    def executescript(self, *args):
+        return _retry_busy(super(_RetryingCursor, self).executescript, *args)
+
+
+def _decode(data):
+    if not isinstance(data, _BLOB_TYPES):
+        return json.loads(data)
+    data = bytes(data)
+    if data[:1] == _TAG_ZLIB:
+        data = zlib.decompress(data[1:])
+    tag, payload = data[:1], data[1:]
+    if tag == _TAG_JSON:
+        return json.loads(payload.decode('UTF-8'))
+    if tag == _TAG_MARSHAL:
+        return marshal.loads(payload)
+    if tag == _TAG_MSGPACK:
+        if msgpack is None:
+            raise ValueError('Value encoded with msgpack, which is not '
+                             'installed')
+        return msgpack.unpackb(payload, raw=False)
+    raise ValueError('Unknown value encoding: %r' % tag)
+
+
 def _parse_history(d):
-    return (d[0], d[1], json.loads(d[2]), d[3],
+    return (d[0], d[1], _decode(d[2]), d[3],
             datetime.datetime.strptime(d[-1], "%Y-%m-%dT%H:%M:%S.%f"))
 
 
@@ -427,7 +898,9 @@ class HookData(object):
     """Simple integration for existing hook exec frameworks.
 
     Records all unit information, and stores deltas for processing
-    by the hook.
+    by the hook. After each successful hook, revision history older than
+    the last ``keep_hooks`` hooks (and older than ``max_age``, if given)
+    is pruned; see :meth:`Storage.compact`.
 
     Sample::
 
@@ -455,10 +928,12 @@ class HookData(object):
                hook.execute()
 
     """
-    def __init__(self):
+    def __init__(self, keep_hooks=KEEP_HOOKS, max_age=None):
         self.kv = kv()
         self.conf = None
         self.rels = None
+        self.keep_hooks = keep_hooks
+        self.max_age = max_age
 
     @contextlib.contextmanager
     def __call__(self):
@@ -469,6 +944,7 @@ class HookData(object):
             self._record_charm_version(hookenv.charm_dir())
             delta_config, delta_relation = self._record_hook(hookenv)
             yield self.kv, delta_config, delta_relation
+        self.kv.compact(self.keep_hooks, self.max_age)
 
     def _record_charm_version(self, charm_dir):
         # Record revisions.. charm revisions are meaningless
@@ -514,8 +990,18 @@ Delta = collections.namedtuple('Delta', ['previous', 'current'])
 _KV = None
 
 
+def kv_configured():
+    """Return True if :func:`kv` is open or knows where to open the
+    database, so calling it will not create one in the working directory
+    outside of a hook."""
+    return (_KV is not None or 'UNIT_STATE_DB' in os.environ or
+            bool(os.environ.get('CHARM_DIR')))
+
+
 def kv():
     global _KV
     if _KV is None:
-        _KV = Storage()
+        # WAL lets readers, such as actions, run alongside a hook's write
+        # transaction.
+        _KV = Storage(journal_mode='wal')
     return _KV
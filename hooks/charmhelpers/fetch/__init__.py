@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import fcntl
 import importlib
+import signal
 from tempfile import NamedTemporaryFile
 import time
 from yaml import safe_load
@@ -120,6 +123,30 @@ APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
 APT_NO_LOCK_RETRY_DELAY = 10  # Wait 10 seconds between apt lock checks.
 APT_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
 
+# Rewritten by dpkg whenever packages are installed or removed.
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# Package lists written by apt-get update, and the configuration they are
+# fetched from.
+APT_LISTS = '/var/lib/apt/lists'
+APT_SOURCES = ('/etc/apt/sources.list', '/etc/apt/sources.list.d',
+               '/etc/apt/trusted.gpg', '/etc/apt/trusted.gpg.d')
+# Entries of APT_LISTS which are not package lists; apt touches them on
+# every run, successful or not.
+APT_LISTS_IGNORE = ('lock', 'partial', 'auxfiles')
+# Written with the local clock after apt-get update, unlike the lists whose
+# mtime is the server's Last-Modified; the first existing one is used.
+APT_UPDATE_STAMPS = ('/var/lib/apt/periodic/update-success-stamp',
+                     '/var/cache/apt/pkgcache.bin')
+
+# dpkg's locks, in the order apt takes them; lock-frontend only exists
+# with apt >= 1.6.
+APT_LOCKS = ('/var/lib/dpkg/lock-frontend', '/var/lib/dpkg/lock')
+# Longest wait for the locks before running apt anyway.
+APT_LOCK_TIMEOUT = APT_NO_LOCK_RETRY_DELAY * APT_NO_LOCK_RETRY_COUNT
+# Polling interval, only used when waiting outside the main thread.
+APT_LOCK_POLL_INTERVAL = 0.5
+
 
 class SourceConfigError(Exception):
     pass
@@ -159,12 +186,10 @@ class BaseFetchHandler(object):
 
 def filter_installed_packages(packages):
     """Returns a list of packages that require installation"""
-    cache = apt_cache()
     _pkgs = []
     for package in packages:
         try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
+            installed_version(package) or _pkgs.append(package)
         except KeyError:
             log('Package {} has no installation candidate.'.format(package),
                 level='WARNING')
@@ -172,14 +197,64 @@ def filter_installed_packages(packages):
     return _pkgs
 
 
+# Process-wide apt cache, the dpkg status mtime it was built at, and the
+# installed versions looked up in it so far.
+_apt_cache = None
+_apt_cache_stamp = None
+_installed_versions = {}
+_apt_pkg_initialised = False
+
+
+def _dpkg_status_stamp():
+    try:
+        return os.stat(DPKG_STATUS).st_mtime
+    except OSError:
+        return None
+
+
 def apt_cache(in_memory=True):
-    """Build and return an apt cache"""
+    """Return the process-wide apt cache.
+
+    It is built on first use and rebuilt after apt commands run through
+    this module, or when dpkg's status file has changed since.
+    """
+    global _apt_cache, _apt_cache_stamp, _apt_pkg_initialised
     from apt import apt_pkg
-    apt_pkg.init()
+    if not _apt_pkg_initialised:
+        apt_pkg.init()
+        _apt_pkg_initialised = True
     if in_memory:
         apt_pkg.config.set("Dir::Cache::pkgcache", "")
         apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
-    return apt_pkg.Cache()
+    stamp = _dpkg_status_stamp()
+    if _apt_cache is None or stamp != _apt_cache_stamp:
+        _apt_cache = apt_pkg.Cache()
+        _apt_cache_stamp = stamp
+        _installed_versions.clear()
+    return _apt_cache
+
+
+def invalidate_apt_cache():
+    """Rebuild the apt cache on next use"""
+    global _apt_cache
+    _apt_cache = None
+    _installed_versions.clear()
+
+
+def installed_version(package):
+    """Return the installed version of package, or None if not installed.
+
+    :raises KeyError: If apt does not know the package
+    """
+    cache = apt_cache()
+    try:
+        return _installed_versions[package]
+    except KeyError:
+        pass
+    pkg = cache[package]
+    version = pkg.current_ver.ver_str if pkg.current_ver else None
+    _installed_versions[package] = version
+    return version
 
 
 def apt_install(packages, options=None, fatal=False):
@@ -214,6 +289,41 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
+def _newest_mtime(paths):
+    """Newest mtime of paths and, for directories, their entries"""
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    mtimes.append(os.lstat(os.path.join(path, name)).st_mtime)
+        except OSError:
+            continue
+    return max(mtimes) if mtimes else None
+
+
+def apt_lists_stale():
+    """Return True if the apt package lists are missing or were last
+    updated before the sources configuration changed, i.e. apt_update()
+    is needed"""
+    lists = [name for name in (os.listdir(APT_LISTS)
+                               if os.path.isdir(APT_LISTS) else [])
+             if name not in APT_LISTS_IGNORE]
+    if not lists:
+        return True
+    for stamp in APT_UPDATE_STAMPS:
+        updated = _newest_mtime([stamp])
+        if updated is not None:
+            break
+    else:
+        return True
+    sources_mtime = _newest_mtime(APT_SOURCES)
+    if sources_mtime is None:
+        return False
+    return sources_mtime >= updated
+
+
 def apt_update(fatal=False):
     """Update local apt cache"""
     cmd = ['apt-get', 'update']
@@ -427,6 +537,136 @@ def plugins(fetch_handlers=None):
     return plugin_list
 
 
+class _LockTimeout(Exception):
+    pass
+
+
+def _raise_lock_timeout(signum, frame):
+    raise _LockTimeout()
+
+
+def _try_lock(fd):
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+def _lock_until(fd, deadline):
+    """Take an exclusive lock on fd, blocking until deadline at the latest.
+
+    Blocks in fcntl with a SIGALRM timer, so the lock is taken as soon as
+    it is released; outside the main thread, where signal handlers cannot
+    be installed, it polls instead. A timer the caller already set is
+    suspended meanwhile, cuts the wait short if due first, and is rearmed
+    with its remaining time, along with its handler, afterwards.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return _try_lock(fd)
+    start = time.time()
+    previous_timer = signal.setitimer(signal.ITIMER_REAL, 0)
+    try:
+        previous = signal.signal(signal.SIGALRM, _raise_lock_timeout)
+    except ValueError:
+        if previous_timer[0]:
+            signal.setitimer(signal.ITIMER_REAL, *previous_timer)
+        while not _try_lock(fd):
+            if time.time() >= deadline:
+                return False
+            time.sleep(APT_LOCK_POLL_INTERVAL)
+        return True
+    if previous_timer[0]:
+        remaining = min(remaining, previous_timer[0])
+    signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        return True
+    except _LockTimeout:
+        return False
+    except (IOError, OSError) as e:
+        if e.errno == errno.EINTR:
+            return False
+        raise
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        if previous_timer[0]:
+            # Fire straight away if it fell due while waiting.
+            signal.setitimer(
+                signal.ITIMER_REAL,
+                max(previous_timer[0] - (time.time() - start), 1e-6),
+                previous_timer[1])
+
+
+def apt_lock_holder(path):
+    """Return the pid of the process holding a lock on path, from
+    /proc/locks, or None"""
+    try:
+        st = os.stat(path)
+        with open('/proc/locks') as f:
+            locks = f.readlines()
+    except (IOError, OSError):
+        return None
+    inode = '{:02x}:{:02x}:{}'.format(os.major(st.st_dev),
+                                       os.minor(st.st_dev), st.st_ino)
+    for line in locks:
+        # e.g. "1: POSIX  ADVISORY  WRITE 1234 fd:01:393260 0 EOF"; waiters
+        # are listed with an extra "->" field and skipped.
+        fields = line.split()
+        if len(fields) > 5 and fields[5] == inode:
+            return int(fields[4])
+    return None
+
+
+def _describe_pid(pid):
+    try:
+        with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+            cmdline = f.read().replace(b'\0', b' ').decode('UTF-8').strip()
+    except (IOError, OSError):
+        cmdline = ''
+    return '{} ({})'.format(pid, cmdline) if cmdline else str(pid)
+
+
+def wait_for_apt_locks(timeout=APT_LOCK_TIMEOUT):
+    """Wait until no other process holds dpkg's locks.
+
+    The locks are taken in order, only to wait for them, and each is
+    released before waiting for the next, so other apt and dpkg clients
+    are never held up. Lock files which do not exist or cannot be opened
+    (e.g. when not root) are ignored.
+
+    :param float timeout: Maximum number of seconds to wait
+    :returns: True if the locks were free, False on timeout, None if none
+              of the lock files could be opened
+    """
+    deadline = time.time() + timeout
+    opened = False
+    for path in APT_LOCKS:
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            continue
+        opened = True
+        try:
+            if _try_lock(fd):
+                continue
+            holder = apt_lock_holder(path)
+            log('Waiting up to {:.0f}s for {} held by {}'.format(
+                max(deadline - time.time(), 0), path,
+                _describe_pid(holder) if holder else 'another process'))
+            if not _lock_until(fd, deadline):
+                log("Timed out waiting for {}".format(path), level='WARNING')
+                return False
+        finally:
+            # Closing releases the lock.
+            os.close(fd)
+    return True if opened else None
+
+
 def _run_apt_command(cmd, fatal=False):
     """
     Run an APT command, checking output and retrying if the fatal flag is set
@@ -441,24 +681,34 @@ def _run_apt_command(cmd, fatal=False):
     if 'DEBIAN_FRONTEND' not in env:
         env['DEBIAN_FRONTEND'] = 'noninteractive'
 
-    if fatal:
-        retry_count = 0
-        result = None
-
-        # If the command is considered "fatal", we need to retry if the apt
-        # lock was not acquired.
-
-        while result is None or result == APT_NO_LOCK:
-            try:
-                result = subprocess.check_call(cmd, env=env)
-            except subprocess.CalledProcessError as e:
-                retry_count = retry_count + 1
-                if retry_count > APT_NO_LOCK_RETRY_COUNT:
-                    raise
-                result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
+    try:
+        wait_for_apt_locks()
+        if fatal:
+            retry_count = 0
+            result = None
+
+            # If the command is considered "fatal", we need to retry if the apt
+            # lock was not acquired.
+
+            while result is None or result == APT_NO_LOCK:
+                try:
+                    result = subprocess.check_call(cmd, env=env)
+                except subprocess.CalledProcessError as e:
+                    retry_count = retry_count + 1
+                    if retry_count > APT_NO_LOCK_RETRY_COUNT:
+                        raise
+                    result = e.returncode
+                    if result != APT_NO_LOCK:
+                        continue
+                    # Lost a race for the lock; retry as soon as it is
+                    # released rather than after a fixed delay.
+                    log("Couldn't acquire DPKG lock. Will retry within {} "
+                        "seconds.".format(APT_NO_LOCK_RETRY_DELAY))
+                    if wait_for_apt_locks(APT_NO_LOCK_RETRY_DELAY) is None:
+                        time.sleep(APT_NO_LOCK_RETRY_DELAY)
 
-    else:
-        subprocess.call(cmd, env=env)
+        else:
+            subprocess.call(cmd, env=env)
+    finally:
+        # Whatever apt did, cached package state may now be out of date.
+        invalidate_apt_cache()
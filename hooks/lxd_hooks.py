@@ -32,12 +32,15 @@ from lxd_utils import (
     configure_lxd_remote,
     configure_lxd_host,
     assess_status,
+    LXD_HOST_CONFIG,
 )
 
 from charmhelpers.fetch import (
     apt_update,
     apt_install,
+    apt_lists_stale,
     add_source,
+    filter_installed_packages,
 )
 
 hooks = Hooks()
@@ -46,10 +49,18 @@ hooks = Hooks()
 @hooks.hook()
 def install():
     status_set('maintenance', 'Installing LXD packages')
+    packages = determine_packages()
     if config('source'):
+        # Installed packages may be upgraded from the configured source.
         add_source(config('source'))
-    apt_update(fatal=True)
-    apt_install(determine_packages(), fatal=True)
+    else:
+        packages = filter_installed_packages(packages)
+    if packages:
+        if apt_lists_stale():
+            apt_update(fatal=True)
+        apt_install(packages, fatal=True)
+    else:
+        log('LXD packages already installed, skipping apt')
     if config('use-source'):
         install_lxd_source()
         configure_lxd_source()
@@ -57,11 +68,17 @@ def install():
 
 @hooks.hook()
 def config_changed():
-    e_mountpoint = config('ephemeral-unmount')
+    conf = config()
+    e_mountpoint = conf.get('ephemeral-unmount')
     if e_mountpoint and filesystem_mounted(e_mountpoint):
         umount(e_mountpoint)
+    # Not skipped when unchanged: configure_lxd_block returns early while
+    # the block device is unusable, and is cheap once storage is set up.
     configure_lxd_block()
-    configure_lxd_host()
+    if conf.any_changed(*LXD_HOST_CONFIG):
+        configure_lxd_host()
+    else:
+        log('LXD host configuration unchanged, skipping')
 
 
 @hooks.hook('lxd-migration-relation-joined')
@@ -74,7 +91,7 @@ def lxd_relation_joined(rid=None):
                  relation_settings=settings)
 
 
-@hooks.hook('lxd-relation-changed')
+@hooks.hook('lxd-relation-changed', relation=['user'])
 def lxd_relation_changed():
     user = relation_get('user')
     if user:
@@ -89,7 +106,8 @@ def lxd_relation_changed():
                 lxd_migration_relation_changed(rid, unit)
 
 
-@hooks.hook('lxd-migration-relation-changed')
+@hooks.hook('lxd-migration-relation-changed',
+            relation=['password', 'hostname', 'address'])
 def lxd_migration_relation_changed(rid=None, unit=None):
     settings = {
         'password': relation_get('password',
@@ -116,11 +134,12 @@ def lxd_migration_relation_changed(rid=None, unit=None):
 
 
 def main():
-    try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        log("Unknown hook {} - skipping.".format(e))
-    assess_status()
+    with hooks.trace():
+        try:
+            hooks.execute(sys.argv)
+        except UnregisteredHookError as e:
+            log("Unknown hook {} - skipping.".format(e))
+        assess_status()
 
 if __name__ == "__main__":
     main()
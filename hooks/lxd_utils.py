@@ -22,8 +22,10 @@ from charmhelpers.core.unitdata import kv
 from charmhelpers.core.host import (
     add_group,
     add_user_to_group,
+    fstab_batch,
     mkdir,
     mount,
+    mount_table,
     mounts,
     umount,
     service_stop,
@@ -74,6 +76,13 @@ LXD_GIT = 'github.com/lxc/lxd'
 DEFAULT_LOOPBACK_SIZE = '10G'
 PW_LENGTH = 16
 
+# configure_lxd_host reads no options itself; the LXD daemon it configures
+# only changes when the install source does.
+LXD_HOST_CONFIG = [
+    'source',
+    'use-source',
+]
+
 
 def install_lxd():
     '''Install LXD'''
@@ -317,7 +326,7 @@ def determine_packages():
 
 
 def filesystem_mounted(fs):
-    return fs in [f for f, m in mounts()]
+    return fs in mount_table()
 
 
 def lxd_trust_password():
@@ -381,11 +390,12 @@ def clean_storage(block_device):
 
     :param block_device: str: Full path to block device to clean.
     '''
-    for mp, d in mounts():
-        if d == block_device:
-            log('clean_storage(): Found %s mounted @ %s, unmounting.' %
-                (d, mp))
-            umount(mp, persist=True)
+    with fstab_batch():
+        for mp, d in mounts():
+            if d == block_device:
+                log('clean_storage(): Found %s mounted @ %s, unmounting.' %
+                    (d, mp))
+                umount(mp, persist=True)
 
     if is_lvm_physical_volume(block_device):
         deactivate_lvm_volume_group(block_device)
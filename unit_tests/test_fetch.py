@@ -0,0 +1,284 @@
+"""Tests for charmhelpers.fetch."""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+import mock
+
+from charmhelpers import fetch
+
+
+class TestAptListsStale(unittest.TestCase):
+    """Tests for fetch.apt_lists_stale."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.lists = os.path.join(self.tmpdir, 'lists')
+        os.mkdir(self.lists)
+        self.sources = os.path.join(self.tmpdir, 'sources.list')
+        self.stamp = os.path.join(self.tmpdir, 'update-success-stamp')
+        self.pkgcache = os.path.join(self.tmpdir, 'pkgcache.bin')
+        for name, value in (('APT_LISTS', self.lists),
+                            ('APT_SOURCES', (self.sources,)),
+                            ('APT_UPDATE_STAMPS',
+                             (self.stamp, self.pkgcache))):
+            patcher = mock.patch.object(fetch, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def touch(self, path, mtime):
+        open(path, 'a').close()
+        os.utime(path, (mtime, mtime))
+
+    def test_no_lists(self):
+        """Missing lists are stale."""
+        self.touch(os.path.join(self.lists, 'lock'), 300)
+        self.touch(self.stamp, 300)
+
+        self.assertTrue(fetch.apt_lists_stale())
+
+    def test_updated_after_sources(self):
+        """Lists are fresh when updated after the sources changed, however
+        old the server timestamps on the lists are."""
+        self.touch(os.path.join(self.lists, 'archive_Packages'), 100)
+        self.touch(self.sources, 200)
+        self.touch(self.stamp, 300)
+
+        self.assertFalse(fetch.apt_lists_stale())
+
+    def test_sources_changed(self):
+        """Lists are stale when the sources changed since the update."""
+        self.touch(os.path.join(self.lists, 'archive_Packages'), 100)
+        self.touch(self.stamp, 300)
+        self.touch(self.sources, 400)
+
+        self.assertTrue(fetch.apt_lists_stale())
+
+    def test_pkgcache_fallback(self):
+        """The package cache is used without an update stamp."""
+        self.touch(os.path.join(self.lists, 'archive_Packages'), 100)
+        self.touch(self.sources, 200)
+        self.touch(self.pkgcache, 300)
+
+        self.assertFalse(fetch.apt_lists_stale())
+
+    def test_no_stamp(self):
+        """Lists are stale when it is unknown when they were updated."""
+        self.touch(os.path.join(self.lists, 'archive_Packages'), 100)
+        self.touch(self.sources, 200)
+
+        self.assertTrue(fetch.apt_lists_stale())
+
+
+# Holds an exclusive lock on argv[1] until stdin is closed.
+_HOLD_LOCK = """
+import fcntl, os, sys
+fd = os.open(sys.argv[1], os.O_RDWR)
+fcntl.lockf(fd, fcntl.LOCK_EX)
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+# Exits 0 if a lock on argv[1] can be taken straight away.
+_TRY_LOCK = """
+import fcntl, os, sys
+fd = os.open(sys.argv[1], os.O_RDWR)
+try:
+    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except (IOError, OSError):
+    sys.exit(1)
+"""
+
+
+class TestWaitForAptLocks(unittest.TestCase):
+    """Tests for fetch.wait_for_apt_locks."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.frontend = os.path.join(self.tmpdir, 'lock-frontend')
+        self.lock = os.path.join(self.tmpdir, 'lock')
+        for path in (self.frontend, self.lock):
+            open(path, 'w').close()
+        patcher = mock.patch.object(fetch, 'APT_LOCKS',
+                                    (self.frontend, self.lock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(fetch, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hold(self, path):
+        holder = subprocess.Popen([sys.executable, '-c', _HOLD_LOCK, path],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+        holder.stdout.readline()
+
+        def release():
+            holder.stdin.close()
+            holder.wait()
+        self.addCleanup(release)
+        return release
+
+    def lockable(self, path):
+        return subprocess.call([sys.executable, '-c', _TRY_LOCK, path]) == 0
+
+    def test_free(self):
+        """Free locks are reported free and released again."""
+        self.assertTrue(fetch.wait_for_apt_locks(1))
+
+        self.assertTrue(self.lockable(self.frontend))
+        self.assertTrue(self.lockable(self.lock))
+
+    def test_no_lock_files(self):
+        """None is returned when no lock file can be opened."""
+        os.unlink(self.frontend)
+        os.unlink(self.lock)
+
+        self.assertIsNone(fetch.wait_for_apt_locks(1))
+
+    def test_timeout(self):
+        """False is returned once the timeout expires."""
+        self.hold(self.lock)
+
+        start = time.time()
+        self.assertFalse(fetch.wait_for_apt_locks(0.2))
+        self.assertLess(time.time() - start, 5)
+
+    def test_released_while_waiting(self):
+        """The wait ends when the holder releases the lock."""
+        release = self.hold(self.lock)
+        timer = threading.Timer(0.2, release)
+        timer.start()
+        self.addCleanup(timer.join)
+
+        start = time.time()
+        self.assertTrue(fetch.wait_for_apt_locks(10))
+        self.assertLess(time.time() - start, 5)
+
+    def test_earlier_lock_not_held(self):
+        """lock-frontend is released while waiting for the dpkg lock."""
+        self.hold(self.lock)
+        frontend_free = []
+
+        def lock_until(fd, deadline):
+            frontend_free.append(self.lockable(self.frontend))
+            return False
+        with mock.patch.object(fetch, '_lock_until', lock_until):
+            self.assertFalse(fetch.wait_for_apt_locks(1))
+
+        self.assertEqual([True], frontend_free)
+
+    def test_caller_timer_restored(self):
+        """A timer set by the caller keeps its handler and remaining
+        time."""
+        self.hold(self.lock)
+        handler = mock.Mock()
+        previous = signal.signal(signal.SIGALRM, handler)
+        self.addCleanup(signal.signal, signal.SIGALRM, previous)
+        signal.setitimer(signal.ITIMER_REAL, 30)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        self.assertFalse(fetch.wait_for_apt_locks(0.2))
+
+        self.assertIs(handler, signal.getsignal(signal.SIGALRM))
+        remaining = signal.getitimer(signal.ITIMER_REAL)[0]
+        self.assertTrue(25 < remaining < 30, remaining)
+        self.assertFalse(handler.called)
+
+    def test_caller_timer_due_first(self):
+        """A caller's timer due before the timeout still fires."""
+        self.hold(self.lock)
+        fired = []
+        previous = signal.signal(signal.SIGALRM,
+                                 lambda *args: fired.append(True))
+        self.addCleanup(signal.signal, signal.SIGALRM, previous)
+        signal.setitimer(signal.ITIMER_REAL, 0.1)
+
+        fetch.wait_for_apt_locks(5)
+        time.sleep(0.1)
+
+        self.assertEqual([True], fired)
+
+
+class TestAptCache(unittest.TestCase):
+    """Tests for the shared fetch.apt_cache and installed_version."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.status = os.path.join(self.tmpdir, 'status')
+        self.touch(1000)
+        self.packages = {
+            'lxd': mock.Mock(current_ver=mock.Mock(ver_str='2.0.11')),
+            'criu': mock.Mock(current_ver=None),
+        }
+        apt = types.ModuleType('apt')
+        apt.apt_pkg = self.apt_pkg = mock.Mock()
+        self.apt_pkg.Cache.side_effect = lambda: dict(self.packages)
+        for patcher in (mock.patch.dict(sys.modules, {'apt': apt}),
+                        mock.patch.object(fetch, 'DPKG_STATUS', self.status),
+                        mock.patch.object(fetch, '_apt_cache', None),
+                        mock.patch.object(fetch, '_installed_versions', {}),
+                        mock.patch.object(fetch, '_apt_pkg_initialised',
+                                          False),
+                        mock.patch.object(fetch, 'log'),
+                        mock.patch.object(fetch, 'subprocess'),
+                        mock.patch.object(fetch, 'wait_for_apt_locks')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def touch(self, mtime):
+        open(self.status, 'a').close()
+        os.utime(self.status, (mtime, mtime))
+
+    def test_shared(self):
+        """The cache is built once and apt_pkg initialised once."""
+        cache = fetch.apt_cache()
+
+        self.assertIs(cache, fetch.apt_cache())
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
+        self.assertEqual(1, self.apt_pkg.init.call_count)
+
+    def test_installed_version(self):
+        """Installed versions are looked up once per cache."""
+        self.assertEqual('2.0.11', fetch.installed_version('lxd'))
+        self.assertIsNone(fetch.installed_version('criu'))
+        self.assertRaises(KeyError, fetch.installed_version, 'missing')
+
+        self.packages['lxd'] = mock.Mock(current_ver=None)
+        self.assertEqual('2.0.11', fetch.installed_version('lxd'))
+        self.assertEqual(['criu', 'missing'],
+                         fetch.filter_installed_packages(
+                             ['lxd', 'criu', 'missing']))
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
+
+    def test_dpkg_status_changed(self):
+        """The cache is rebuilt when dpkg's status file changes."""
+        fetch.installed_version('lxd')
+        self.packages['lxd'] = mock.Mock(current_ver=None)
+        self.touch(2000)
+
+        self.assertIsNone(fetch.installed_version('lxd'))
+        self.assertEqual(2, self.apt_pkg.Cache.call_count)
+
+    def test_invalidated_by_apt(self):
+        """Running apt through this module rebuilds the cache, even when
+        the command fails."""
+        fetch.installed_version('lxd')
+        self.packages['lxd'] = mock.Mock(current_ver=None)
+        fetch.subprocess.call.side_effect = OSError('apt-get not found')
+
+        self.assertRaises(OSError, fetch.apt_install, ['lxd'])
+
+        self.assertIsNone(fetch.installed_version('lxd'))
+        self.assertEqual(2, self.apt_pkg.Cache.call_count)
@@ -0,0 +1,129 @@
+"""Tests for charmhelpers.core.fstab."""
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+
+from charmhelpers.core import fstab
+
+FSTAB = """# /etc/fstab: static file system information.
+UUID=1234 /               ext4    errors=remount-ro 0       1
+tmpfs   /tmp    tmpfs   defaults        0       0
+"""
+
+
+class TestNormalizeDevice(unittest.TestCase):
+    """Tests for fstab.normalize_device."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_symlink(self):
+        """Device symlinks are resolved to the device node."""
+        node = os.path.join(self.tmpdir, 'vdb')
+        open(node, 'w').close()
+        link = os.path.join(self.tmpdir, 'lxd-disk')
+        os.symlink(node, link)
+
+        self.assertEqual(os.path.realpath(node),
+                         fstab.normalize_device(link))
+
+    def test_uuid(self):
+        """UUID= specs are resolved through /dev/disk/by-uuid."""
+        with mock.patch.object(fstab.os.path, 'exists') as exists, \
+                mock.patch.object(fstab.os.path, 'realpath') as realpath:
+            exists.return_value = True
+            realpath.return_value = '/dev/vdb'
+
+            self.assertEqual('/dev/vdb', fstab.normalize_device('UUID=1234'))
+
+        realpath.assert_called_once_with('/dev/disk/by-uuid/1234')
+
+    def test_unresolved(self):
+        """Specs which do not resolve are returned unchanged."""
+        self.assertEqual('tmpfs', fstab.normalize_device('tmpfs'))
+        self.assertEqual('UUID=no-such-uuid',
+                         fstab.normalize_device('UUID=no-such-uuid'))
+        self.assertEqual('server:/export',
+                         fstab.normalize_device('server:/export'))
+
+
+class TestFstabEditor(unittest.TestCase):
+    """Tests for fstab.FstabEditor."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'fstab')
+        with open(self.path, 'w') as f:
+            f.write(FSTAB)
+        os.chmod(self.path, 0o640)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_batched_changes(self):
+        """Changes are written on commit only, keeping other lines."""
+        with fstab.FstabEditor(self.path) as editor:
+            editor.add_entry(fstab.Fstab.Entry(
+                '/dev/vdb', '/var/lib/lxd', 'btrfs', 'user_subvol_rm_allowed'))
+            editor.remove_by_mountpoint('/tmp/')
+            self.assertEqual(FSTAB, self.read())
+
+        self.assertEqual(
+            FSTAB.splitlines(True)[:2] +
+            ['/dev/vdb /var/lib/lxd btrfs user_subvol_rm_allowed 0 0\n'],
+            self.read().splitlines(True))
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(['fstab'], os.listdir(self.tmpdir))
+
+    def test_duplicate_device(self):
+        """A device already listed under another name is not added."""
+        node = os.path.join(self.tmpdir, 'vdb')
+        open(node, 'w').close()
+        link = os.path.join(self.tmpdir, 'lxd-disk')
+        os.symlink(node, link)
+        with fstab.FstabEditor(self.path) as editor:
+            editor.add_entry(fstab.Fstab.Entry(node, '/srv', 'ext4', None))
+
+        editor = fstab.FstabEditor(self.path)
+
+        self.assertFalse(editor.add_entry(
+            fstab.Fstab.Entry(link, '/srv2', 'ext4', None)))
+        self.assertFalse(editor.dirty)
+
+    def test_unchanged_not_written(self):
+        """The file is not replaced when nothing changed."""
+        inode = os.stat(self.path).st_ino
+
+        with fstab.FstabEditor(self.path) as editor:
+            editor.remove_by_mountpoint('/nonexistent')
+
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+
+    def test_failed_write(self):
+        """The original file is kept and no temporary file is left when
+        the rewrite fails."""
+        editor = fstab.FstabEditor(self.path)
+        editor.remove_by_mountpoint('/tmp')
+
+        with mock.patch.object(fstab.os, 'rename',
+                               side_effect=OSError('read-only')):
+            self.assertRaises(OSError, editor.commit)
+
+        self.assertEqual(FSTAB, self.read())
+        self.assertEqual(['fstab'], os.listdir(self.tmpdir))
+
+    def test_fstab_add_remove(self):
+        """Fstab.add and remove_by_mountpoint go through the editor."""
+        fstab.Fstab.add('/dev/vdc', '/mnt', 'ext4', path=self.path)
+        self.assertIn('/dev/vdc /mnt ext4 defaults 0 0\n', self.read())
+
+        self.assertTrue(fstab.Fstab.remove_by_mountpoint('/mnt',
+                                                         path=self.path))
+        self.assertEqual(FSTAB, self.read())
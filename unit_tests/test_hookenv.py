@@ -0,0 +1,347 @@
+"""Tests for charmhelpers.core.hookenv."""
+import json
+import os
+import sqlite3
+
+import mock
+import yaml
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+import testing
+
+
+class TestHooksInputs(testing.CharmTestCase):
+    """Tests for hookenv.Hooks skipping hooks with unchanged inputs."""
+
+    FIXTURE = {
+        'unit': 'lxd/0',
+        'hook': 'lxd-relation-changed',
+        'relation_id': 'lxd:1',
+        'remote_unit': 'nova-compute/0',
+        'config': {'storage-type': 'btrfs'},
+        'relations': {
+            'lxd': {
+                'lxd:1': {'nova-compute/0': {'user': 'nova'}},
+            },
+        },
+    }
+
+    def setUp(self):
+        super(TestHooksInputs, self).setUp(hookenv, [])
+        self.tools = self.hook_fixture(self.FIXTURE)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.runs = []
+        self.hooks = hookenv.Hooks()
+
+        @self.hooks.hook('lxd-relation-changed', config=['storage-type'],
+                         relation=['user'])
+        def lxd_relation_changed():
+            self.runs.append(hookenv.relation_get('user'))
+
+    def execute(self):
+        hookenv.cache.clear()
+        self.hooks.execute(['lxd-relation-changed'])
+
+    def test_unchanged_inputs_skip(self):
+        """The hook is skipped when its inputs are unchanged."""
+        self.execute()
+        self.execute()
+
+        self.assertEqual(['nova'], self.runs)
+
+    def test_changed_relation_reruns(self):
+        """The hook runs again when a relation input changes."""
+        self.execute()
+        self.tools.relation_settings('lxd:1', 'nova-compute/0')['user'] = 'x'
+        self.execute()
+
+        self.assertEqual(['nova', 'x'], self.runs)
+
+    def test_changed_config_reruns(self):
+        """The hook runs again when a config input changes."""
+        self.execute()
+        self.tools.config['storage-type'] = 'lvm'
+        self.execute()
+
+        self.assertEqual(['nova', 'nova'], self.runs)
+
+    def run_relation_hook(self, hook_name, remote_unit='nova-compute/0'):
+        os.environ['JUJU_REMOTE_UNIT'] = remote_unit
+        hookenv.cache.clear()
+        self.assertRaises(hookenv.UnregisteredHookError,
+                          self.hooks.execute, [hook_name])
+        os.environ['JUJU_REMOTE_UNIT'] = 'nova-compute/0'
+
+    def test_rejoined_unit_reruns(self):
+        """A unit which departs and joins again with the same settings is
+        not skipped."""
+        self.execute()
+        self.run_relation_hook('lxd-relation-departed')
+        self.run_relation_hook('lxd-relation-joined')
+        self.execute()
+
+        self.assertEqual(['nova', 'nova'], self.runs)
+
+    def test_departed_other_unit(self):
+        """Another unit departing keeps the fingerprint."""
+        self.execute()
+        self.run_relation_hook('lxd-relation-departed', 'nova-compute/1')
+        self.execute()
+
+        self.assertEqual(['nova'], self.runs)
+
+    def test_broken_relation(self):
+        """All fingerprints of a broken relation are dropped."""
+        self.execute()
+        self.run_relation_hook('lxd-relation-broken', '')
+        self.execute()
+
+        self.assertEqual(['nova', 'nova'], self.runs)
+
+    def test_failed_hook_not_recorded(self):
+        """No fingerprint is recorded when the hook raises, so it is
+        retried with the same inputs."""
+        def failing():
+            self.runs.append('failed')
+            raise ValueError('boom')
+        self.hooks.register('lxd-relation-changed', failing,
+                            {'relation': ['user']})
+
+        self.assertRaises(ValueError, self.execute)
+        self.assertEqual(
+            {}, unitdata.kv().getrange(hookenv.Hooks.INPUTS_KEY))
+        self.assertRaises(ValueError, self.execute)
+
+        self.assertEqual(['failed', 'failed'], self.runs)
+
+
+class TestHooksTrace(testing.CharmTestCase):
+    """Tests for hookenv.Hooks recording hook tool traces."""
+
+    FIXTURE = {
+        'unit': 'lxd/0',
+        'hook': 'config-changed',
+        'config': {'storage-type': 'btrfs'},
+    }
+
+    def setUp(self):
+        super(TestHooksTrace, self).setUp(hookenv, [])
+        self.hook_fixture(self.FIXTURE)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.hooks = hookenv.Hooks()
+
+    def recorded(self):
+        return unitdata.kv().get(
+            '{}.config-changed'.format(hookenv.Hooks.TRACE_KEY))
+
+    def test_trace_covers_enclosed_block(self):
+        """Calls around the hook are traced along with it."""
+        self.hooks.register('config-changed',
+                            lambda: hookenv.config('storage-type'))
+
+        with self.hooks.trace():
+            self.hooks.execute(['config-changed'])
+            hookenv.status_get()
+
+        trace = self.recorded()
+        self.assertEqual('ok', trace['outcome'])
+        self.assertEqual({'config-get', 'status-get'}, set(trace['tools']))
+
+    def test_trace_failed(self):
+        """A trace is recorded as failed when the hook raises."""
+        def failing():
+            hookenv.config('storage-type')
+            raise ValueError('boom')
+        self.hooks.register('config-changed', failing)
+
+        self.assertRaises(ValueError, self.hooks.execute, ['config-changed'])
+
+        trace = self.recorded()
+        self.assertEqual('failed', trace['outcome'])
+        self.assertEqual(1, trace['forks'])
+
+    def test_trace_without_arguments(self):
+        """Hook tool arguments, which may be secrets, are not recorded."""
+        self.hooks.register('config-changed',
+                            lambda: hookenv.log('password=s3cret'))
+
+        self.hooks.execute(['config-changed'])
+
+        trace = self.recorded()
+        self.assertEqual(['juju-log'], list(trace['tools']))
+        self.assertNotIn('s3cret', json.dumps(trace))
+
+    def test_trace_record_failure(self):
+        """Failing to record the trace does not replace the hook's own
+        exception."""
+        def failing():
+            raise ValueError('boom')
+        self.hooks.register('config-changed', failing)
+        db = mock.Mock()
+        db.update_isolated.side_effect = sqlite3.OperationalError('locked')
+
+        with mock.patch.object(unitdata, 'kv', return_value=db):
+            self.assertRaises(ValueError, self.hooks.execute,
+                              ['config-changed'])
+
+        db.update_isolated.assert_called_once_with(mock.ANY)
+
+
+class TestConfigChangedKeys(testing.CharmTestCase):
+    """Tests for hookenv.Config.changed_keys against a previous config
+    saved in CHARM_DIR."""
+
+    FIXTURE = {
+        'unit': 'lxd/0',
+        'hook': 'config-changed',
+        'config': {'storage-type': 'lvm', 'block-device': '/dev/vdb'},
+        'previous_config': {'storage-type': 'btrfs',
+                            'block-device': '/dev/vdb',
+                            'ephemeral-unmount': '/mnt',
+                            'stored-secret': 's3cret'},
+    }
+
+    OPTIONS = {
+        'options': {
+            'storage-type': {'type': 'string'},
+            'block-device': {'type': 'string'},
+            'ephemeral-unmount': {'type': 'string'},
+        },
+    }
+
+    def setUp(self):
+        super(TestConfigChangedKeys, self).setUp(hookenv, [])
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+
+    def config(self, fixture):
+        self.hook_fixture(fixture)
+        with open(os.path.join(os.environ['CHARM_DIR'],
+                               'config.yaml'), 'w') as f:
+            yaml.safe_dump(self.OPTIONS, f)
+        return hookenv.config()
+
+    def reload(self, conf):
+        conf.save()
+        hookenv.cache.clear()
+        return hookenv.config()
+
+    def test_changed_and_removed(self):
+        """Changed options and options which lost their value are
+        reported."""
+        conf = self.config(self.FIXTURE)
+
+        self.assertEqual(frozenset(['ephemeral-unmount']), conf.removed_keys)
+        self.assertEqual(frozenset(['storage-type', 'ephemeral-unmount']),
+                         conf.changed_keys)
+        self.assertTrue(conf.changed('ephemeral-unmount'))
+        self.assertIsNone(conf.get('ephemeral-unmount'))
+        self.assertFalse(conf.changed('block-device'))
+        self.assertTrue(conf.any_changed('block-device', 'ephemeral-unmount'))
+
+    def test_removed_once(self):
+        """A removed option is only reported in the hook it was removed
+        in."""
+        conf = self.reload(self.config(self.FIXTURE))
+
+        self.assertEqual(frozenset(), conf.removed_keys)
+        self.assertFalse(conf.changed('ephemeral-unmount'))
+
+    def test_stored_value(self):
+        """Values stored by the charm are carried over unchanged."""
+        conf = self.config(self.FIXTURE)
+        self.assertEqual('s3cret', conf['stored-secret'])
+        self.assertFalse(conf.changed('stored-secret'))
+
+        conf = self.reload(conf)
+
+        self.assertEqual('s3cret', conf['stored-secret'])
+        self.assertFalse(conf.changed('stored-secret'))
+        self.assertNotIn('stored-secret', conf.changed_keys)
+
+    def test_unchanged(self):
+        """No key is reported when the config is unchanged."""
+        fixture = dict(self.FIXTURE,
+                       previous_config=self.FIXTURE['config'])
+        conf = self.config(fixture)
+
+        self.assertEqual(frozenset(), conf.changed_keys)
+        self.assertFalse(conf.any_changed('storage-type', 'block-device'))
+
+    def test_no_previous_config(self):
+        """Every key is reported when there is no previous config."""
+        fixture = dict(self.FIXTURE)
+        del fixture['previous_config']
+        conf = self.config(fixture)
+
+        self.assertEqual(frozenset(['storage-type', 'block-device']),
+                         conf.changed_keys)
+
+
+class TestStatusSet(testing.CharmTestCase):
+    """Tests for hookenv.status_set de-duplicating updates."""
+
+    FIXTURE = {
+        'unit': 'lxd/0',
+        'hook': 'config-changed',
+        'status': ['maintenance', 'Installing LXD packages'],
+    }
+
+    def setUp(self):
+        super(TestStatusSet, self).setUp(hookenv, [])
+        self.status_set = testing.hookenv_status_set
+
+    def calls(self, tools, tool):
+        return [c for c in tools.calls if c[0] == tool]
+
+    def test_repeated_status(self):
+        """An identical status is only sent once."""
+        tools = self.hook_fixture(self.FIXTURE)
+
+        self.status_set('active', 'Unit is ready')
+        self.status_set('active', 'Unit is ready')
+
+        self.assertEqual([['status-set', 'active', 'Unit is ready']],
+                         self.calls(tools, 'status-set'))
+        self.assertEqual(['active', 'Unit is ready'], tools.status)
+
+    def test_changed_status(self):
+        """A different status is sent again."""
+        tools = self.hook_fixture(self.FIXTURE)
+
+        self.status_set('active', 'Unit is ready')
+        self.status_set('blocked', 'No storage')
+
+        self.assertEqual(2, len(self.calls(tools, 'status-set')))
+        self.assertEqual(['blocked', 'No storage'], tools.status)
+
+    def test_status_get_fallback(self):
+        """Without a record, status-get is asked once and a status Juju
+        already shows is not sent again."""
+        tools = self.hook_fixture(self.FIXTURE)
+
+        self.status_set('maintenance', 'Installing LXD packages')
+        self.status_set('maintenance', 'Installing LXD packages')
+
+        self.assertEqual([], self.calls(tools, 'status-set'))
+        self.assertEqual(1, len(self.calls(tools, 'status-get')))
+
+    def test_outside_charm(self):
+        """Without CHARM_DIR no unit state database is created."""
+        tools = self.hook_fixture(self.FIXTURE)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(os.environ['CHARM_DIR'])
+        del os.environ['CHARM_DIR']
+        saved_kv, unitdata._KV = unitdata._KV, None
+        self.addCleanup(setattr, unitdata, '_KV', saved_kv)
+
+        self.status_set('active', 'Unit is ready')
+        self.status_set('active', 'Unit is ready')
+
+        self.assertEqual(2, len(self.calls(tools, 'status-set')))
+        self.assertFalse(os.path.exists('.unit-state.db'))
@@ -0,0 +1,630 @@
+"""Tests for charmhelpers.core.host."""
+import grp
+import hashlib
+import os
+import pwd
+import shutil
+import string
+import tempfile
+import time
+
+import mock
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import host
+from charmhelpers.core import unitdata
+
+import testing
+
+
+class TestServiceBatch(testing.CharmTestCase):
+    """Tests for host.service_batch."""
+
+    TO_PATCH = [
+        'init_is_systemd',
+        'service',
+        'service_states',
+        'subprocess',
+    ]
+
+    def setUp(self):
+        super(TestServiceBatch, self).setUp(host, self.TO_PATCH)
+        self.init_is_systemd.return_value = True
+        self.subprocess.CalledProcessError = host.subprocess.CalledProcessError
+        self.service.return_value = True
+        self.subprocess.check_output.return_value = b''
+
+    def states(self, **active_states):
+        return dict((name, host.ServiceState('loaded', state, ''))
+                    for name, state in active_states.items())
+
+    def test_batch_succeeds(self):
+        """A successful batched call is not followed by retries."""
+        self.subprocess.call.return_value = 0
+
+        self.assertTrue(host.service_batch('restart', ['lxd', 'lxcfs']))
+
+        self.subprocess.call.assert_called_once_with(
+            ['systemctl', 'restart', 'lxd', 'lxcfs'])
+        self.assertFalse(self.service.called)
+
+    def restart_props(self, before, after):
+        self.subprocess.call.return_value = 1
+        self.subprocess.check_output.side_effect = [
+            ''.join('ActiveEnterTimestampMonotonic={}\n\n'.format(ts)
+                    for ts in before).encode('UTF-8'),
+            ''.join('ActiveState={}\nActiveEnterTimestampMonotonic={}\n\n'
+                    .format(state, ts)
+                    for state, ts in after).encode('UTF-8'),
+        ]
+
+    def test_restart_fails_retries_not_restarted(self):
+        """Only services which were not restarted are restarted again,
+        even when they are still active from before."""
+        self.restart_props(before=['100', '100'],
+                           after=[('active', '200'), ('active', '100')])
+
+        self.assertTrue(host.service_batch('restart', ['lxd', 'lxcfs']))
+
+        self.service.assert_called_once_with('restart', 'lxcfs')
+
+    def test_restart_fails_retries_failed(self):
+        """Services which failed to come back up are restarted again."""
+        self.restart_props(before=['100', '100'],
+                           after=[('active', '200'), ('failed', '200')])
+
+        host.service_batch('restart', ['lxd', 'lxcfs'])
+
+        self.service.assert_called_once_with('restart', 'lxcfs')
+
+    def test_restart_fails_state_unknown(self):
+        """Every service is restarted again when the state before the
+        batch is unknown."""
+        self.subprocess.call.return_value = 1
+        self.subprocess.check_output.side_effect = (
+            host.subprocess.CalledProcessError(1, 'systemctl'))
+
+        host.service_batch('restart', ['lxd', 'lxcfs'])
+
+        self.assertEqual(2, self.service.call_count)
+
+    def test_start_fails_retries_not_running(self):
+        """Only services which did not come up are started again."""
+        self.subprocess.call.return_value = 1
+        self.service_states.return_value = self.states(lxd='active',
+                                                       lxcfs='failed')
+
+        self.assertTrue(host.service_batch('start', ['lxd', 'lxcfs']))
+
+        self.service.assert_called_once_with('start', 'lxcfs')
+
+    def test_batch_fails_retries_not_stopped(self):
+        """Only services which are still running are stopped again."""
+        self.subprocess.call.return_value = 1
+        self.service_states.return_value = self.states(lxd='active',
+                                                       lxcfs='inactive')
+
+        host.service_batch('stop', ['lxd', 'lxcfs'])
+
+        self.service.assert_called_once_with('stop', 'lxd')
+
+    def test_batch_fails_other_action(self):
+        """Every service is retried for actions with no target state."""
+        self.subprocess.call.return_value = 1
+
+        host.service_batch('enable', ['lxd', 'lxcfs'])
+
+        self.assertFalse(self.service_states.called)
+        self.assertEqual(2, self.service.call_count)
+
+
+class TestFileHash(testing.CharmTestCase):
+    """Tests for host.file_hash and host.file_hashes."""
+
+    def setUp(self):
+        super(TestFileHash, self).setUp(host, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.data = os.urandom(10000)
+        self.path = os.path.join(self.tmpdir, 'lxd.tar.gz')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def test_chunked(self):
+        """Files larger than the buffer hash the same as a single read."""
+        with mock.patch.object(host, 'HASH_CHUNK_SIZE', 4096):
+            hashes = host.file_hashes(self.path)
+            md5 = host.file_hash(self.path)
+
+        self.assertEqual({'md5': hashlib.md5(self.data).hexdigest(),
+                          'sha256': hashlib.sha256(self.data).hexdigest()},
+                         hashes)
+        self.assertEqual(hashes['md5'], md5)
+
+    def test_missing(self):
+        """None is returned for a missing file."""
+        path = os.path.join(self.tmpdir, 'missing')
+
+        self.assertIsNone(host.file_hashes(path))
+        self.assertIsNone(host.file_hash(path, 'sha256'))
+
+
+class TestPathFingerprints(testing.CharmTestCase):
+    """Tests for host.path_hash and host.path_fingerprints."""
+
+    def setUp(self):
+        super(TestPathFingerprints, self).setUp(host, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.pattern = os.path.join(self.tmpdir, '*.conf')
+        self.paths = [self.write(name, name)
+                      for name in ('a.conf', 'b.conf', 'c.conf')]
+
+    def write(self, name, data, age=60):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def md5(self, path):
+        return hashlib.md5(open(path, 'rb').read()).hexdigest()
+
+    def test_path_hash(self):
+        """Every matching file is hashed."""
+        self.assertEqual(dict((path, self.md5(path)) for path in self.paths),
+                         host.path_hash(self.pattern))
+        self.assertEqual({}, host.path_hash(os.path.join(self.tmpdir, '*.x')))
+
+    def test_fingerprints(self):
+        """Fingerprints carry the stat and hash of every matching file."""
+        fingerprints = host.path_fingerprints(self.pattern)
+
+        self.assertEqual(sorted(self.paths), sorted(fingerprints))
+        for path in self.paths:
+            st = os.stat(path)
+            self.assertEqual([st.st_size, st.st_ino, self.md5(path)],
+                             [fingerprints[path][0], fingerprints[path][2],
+                              fingerprints[path][3]])
+
+    def test_only_changed_hashed(self):
+        """Only files whose stat changed are hashed again."""
+        previous = host.path_fingerprints(self.pattern)
+        self.write('b.conf', 'changed')
+
+        with mock.patch.object(host, 'file_hash',
+                               wraps=host.file_hash) as file_hash:
+            fingerprints = host.path_fingerprints(self.pattern, previous)
+
+        file_hash.assert_called_once_with(self.paths[1])
+        self.assertEqual(self.md5(self.paths[1]),
+                         fingerprints[self.paths[1]][3])
+        self.assertEqual(previous[self.paths[0]], fingerprints[self.paths[0]])
+
+    def test_recent_rehashed(self):
+        """Files modified too recently to tell are always hashed."""
+        self.write('a.conf', 'a', age=0)
+        previous = host.path_fingerprints(self.pattern)
+
+        with mock.patch.object(host, 'file_hash',
+                               wraps=host.file_hash) as file_hash:
+            host.path_fingerprints(self.pattern, previous)
+
+        file_hash.assert_called_once_with(self.paths[0])
+
+
+MOUNTINFO = """\
+22 1 253:1 / / rw,relatime shared:1 - ext4 /dev/vda1 rw
+40 22 0:35 / /var/lib/lxd rw shared:20 master:3 - btrfs /dev/vdb rw
+41 22 0:36 / /mnt/my\\040disk rw - ext4 /dev/disk\\011x rw
+"""
+
+
+class TestMountTable(testing.CharmTestCase):
+    """Tests for host.MountTable."""
+
+    TO_PATCH = [
+        'subprocess',
+    ]
+
+    def setUp(self):
+        super(TestMountTable, self).setUp(host, self.TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'mountinfo')
+        self.write(MOUNTINFO)
+        self.table = host.MountTable(self.path)
+        patcher = mock.patch.object(host, '_mount_table', self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, data):
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+    def test_parse(self):
+        """Mounts are parsed in order, with escapes and optional fields."""
+        self.assertEqual(
+            [host.Mount('/', '/dev/vda1', 'ext4', 'rw,relatime'),
+             host.Mount('/var/lib/lxd', '/dev/vdb', 'btrfs', 'rw'),
+             host.Mount('/mnt/my disk', '/dev/disk\tx', 'ext4', 'rw')],
+            host.mount_table().entries)
+        self.assertEqual([['/', '/dev/vda1'], ['/var/lib/lxd', '/dev/vdb'],
+                          ['/mnt/my disk', '/dev/disk\tx']], host.mounts())
+        self.assertIn('/mnt/my disk', self.table)
+        self.assertNotIn('/mnt', self.table)
+
+    def test_overmounted(self):
+        """The topmost mount on a mountpoint wins."""
+        self.write(MOUNTINFO + '42 40 0:37 / /var/lib/lxd rw - zfs lxd rw\n')
+
+        self.assertEqual('zfs', self.table.get('/var/lib/lxd').fstype)
+
+    def test_cached(self):
+        """The table is re-read after mount and umount."""
+        self.assertIn('/var/lib/lxd', self.table)
+        self.write(MOUNTINFO.splitlines(True)[0])
+        self.assertIn('/var/lib/lxd', self.table)
+
+        self.assertTrue(host.umount('/var/lib/lxd'))
+
+        self.assertNotIn('/var/lib/lxd', self.table)
+        self.write(MOUNTINFO)
+        self.assertTrue(host.mount('/dev/vdb', '/var/lib/lxd'))
+        self.assertIn('/var/lib/lxd', self.table)
+
+    def test_proc(self):
+        """The mounts of this process are read from /proc."""
+        if not os.path.exists(host.MountTable.PATH):
+            self.skipTest('no /proc/self/mountinfo')
+
+        self.assertIn('/', host.MountTable())
+
+
+class FakeSysfsMixin(object):
+    """Builds a fake /sys/class/net and points host.SYS_NET at it."""
+
+    def setup_sysfs(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        self.sys_net = os.path.join(self.sysfs, 'class', 'net')
+        os.makedirs(self.sys_net)
+        patcher = mock.patch.object(host, 'SYS_NET', self.sys_net)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+
+    def add_nic(self, name, index, mtu='1500', hwaddr=None, physical=True,
+                master=None, kind=None):
+        bus = 'pci0000:00' if physical else 'virtual'
+        path = os.path.join(self.sysfs, 'devices', bus, 'net', name)
+        os.makedirs(path)
+        files = {'ifindex': index, 'mtu': mtu,
+                 'type': '1' if hwaddr else '772',
+                 'address': hwaddr or '00:00:00:00:00:00'}
+        for filename, value in files.items():
+            with open(os.path.join(path, filename), 'w') as f:
+                f.write('{}\n'.format(value))
+        if kind:
+            os.mkdir(os.path.join(path, kind))
+        if master:
+            os.symlink(os.path.join(self.sys_net, master),
+                       os.path.join(path, 'master'))
+        os.symlink(path, os.path.join(self.sys_net, name))
+
+
+class TestNicInventory(FakeSysfsMixin, testing.CharmTestCase):
+    """Tests for host NIC lookups served from sysfs."""
+
+    TO_PATCH = [
+        'subprocess',
+    ]
+
+    def setUp(self):
+        super(TestNicInventory, self).setUp(host, self.TO_PATCH)
+        self.setup_sysfs()
+        self.add_nic('lo', 1, mtu='65536', physical=False)
+        self.add_nic('bond0', 4, hwaddr='52:54:00:00:00:01', physical=False,
+                     kind='bonding')
+        self.add_nic('eth1', 3, hwaddr='52:54:00:00:00:01', master='bond0')
+        self.add_nic('eth0', 2, hwaddr='52:54:00:00:00:00')
+        self.add_nic('br0', 5, mtu='9000', hwaddr='52:54:00:00:00:02',
+                     physical=False, kind='bridge')
+        self.add_nic('eth0.100', 6, hwaddr='52:54:00:00:00:00',
+                     physical=False)
+
+    def test_inventory(self):
+        """Interfaces are listed in ifindex order with their details."""
+        inventory = host.nic_inventory()
+
+        self.assertEqual(['lo', 'eth0', 'eth1', 'bond0', 'br0', 'eth0.100'],
+                         list(inventory))
+        self.assertEqual(host.Nic('eth1', 3, '1500', '52:54:00:00:00:01',
+                                  True, 'bond0', 'bond0', False, False),
+                         inventory['eth1'])
+        self.assertEqual('', inventory['lo'].hwaddr)
+        self.assertTrue(inventory['bond0'].bond)
+        self.assertTrue(inventory['br0'].bridge)
+
+    def test_list_nics(self):
+        """All interfaces are in ifindex order, and interfaces of given
+        types are grouped by type in the order the types were given."""
+        self.assertEqual(['lo', 'eth0', 'eth1', 'bond0', 'br0', 'eth0.100'],
+                         host.list_nics())
+        self.assertEqual(['eth0', 'eth1', 'eth0.100'], host.list_nics('eth'))
+        self.assertEqual(['br0', 'bond0', 'eth0', 'eth1', 'eth0.100'],
+                         host.list_nics(['br', 'bond', 'eth']))
+        self.assertFalse(self.subprocess.check_output.called)
+
+    def test_lookups(self):
+        """Single interface lookups are answered from sysfs."""
+        self.assertEqual('9000', host.get_nic_mtu('br0'))
+        self.assertEqual('52:54:00:00:00:00', host.get_nic_hwaddr('eth0'))
+        self.assertTrue(host.is_phy_iface('eth1'))
+        self.assertFalse(host.is_phy_iface('bond0'))
+        self.assertFalse(host.is_phy_iface('eth9'))
+        self.assertEqual('bond0', host.get_bond_master('eth1'))
+        self.assertIsNone(host.get_bond_master('eth0'))
+        self.assertFalse(self.subprocess.check_output.called)
+
+    def test_cached(self):
+        """sysfs is read once per hook."""
+        host.nic_inventory()
+        self.add_nic('eth2', 7)
+
+        self.assertNotIn('eth2', host.list_nics())
+        hookenv.flush('nic_inventory')
+        self.assertIn('eth2', host.list_nics())
+
+
+class TestSetNicMtus(FakeSysfsMixin, testing.CharmTestCase):
+    """Tests for host.set_nic_mtus."""
+
+    TO_PATCH = [
+        '_ip_batch',
+    ]
+
+    def setUp(self):
+        super(TestSetNicMtus, self).setUp(host, self.TO_PATCH)
+        self.setup_sysfs()
+        self.add_nic('eth0', 2, hwaddr='52:54:00:00:00:00', master='bond0')
+        self.add_nic('eth1', 3, hwaddr='52:54:00:00:00:01', master='bond0')
+        self.add_nic('bond0', 4, hwaddr='52:54:00:00:00:00', physical=False,
+                     master='br0', kind='bonding')
+        self.add_nic('br0', 5, hwaddr='52:54:00:00:00:00', physical=False,
+                     kind='bridge')
+        self.batches = []
+        self.refuse = set()
+        self._ip_batch.side_effect = self.ip_batch
+
+    def ip_batch(self, commands, force=False):
+        self.batches.append(([c.split()[3] for c in commands], force))
+        for command in commands:
+            _, _, _, nic, _, mtu = command.split()
+            if nic in self.refuse:
+                return (1, 'Error: mtu greater than device maximum.\n')
+            with open(os.path.join(self.sys_net, nic, 'mtu'), 'w') as f:
+                f.write(mtu + '\n')
+        return (0, '')
+
+    def mtus(self):
+        hookenv.flush('nic_inventory')
+        return dict((nic, host.get_nic_mtu(nic))
+                    for nic in ('eth0', 'eth1', 'bond0', 'br0'))
+
+    def test_increase(self):
+        """Increases go to slaves before their masters, in one batch."""
+        host.set_nic_mtus({'br0': 9000, 'bond0': 9000, 'eth1': 9000,
+                           'eth0': 9000})
+
+        order, force = self.batches[0]
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual(['br0'], order[3:])
+        self.assertEqual(['bond0'], order[2:3])
+        self.assertEqual(dict.fromkeys(('eth0', 'eth1', 'bond0', 'br0'),
+                                       '9000'), self.mtus())
+
+    def test_decrease(self):
+        """Decreases go to masters before their slaves."""
+        host.set_nic_mtus({'eth0': 1400, 'bond0': 1400, 'br0': 1400})
+
+        self.assertEqual((['br0', 'bond0', 'eth0'], False), self.batches[0])
+
+    def test_unchanged(self):
+        """Nothing is run when every MTU is already set."""
+        host.set_nic_mtus({'eth0': 1500, 'br0': '1500'})
+
+        self.assertEqual([], self.batches)
+
+    def test_rollback(self):
+        """On failure the MTUs already changed are set back."""
+        self.refuse.add('br0')
+
+        with self.assertRaises(host.NicMtuError) as cm:
+            host.set_nic_mtus({'eth0': 9000, 'eth1': 9000, 'bond0': 9000,
+                               'br0': 9000})
+
+        self.assertIn('br0', str(cm.exception))
+        self.assertIn('mtu greater than device maximum', str(cm.exception))
+        rollback, force = self.batches[1]
+        self.assertTrue(force)
+        self.assertEqual('bond0', rollback[0])
+        self.assertEqual(['eth0', 'eth1'], sorted(rollback[1:]))
+        self.assertEqual(dict.fromkeys(('eth0', 'eth1', 'bond0', 'br0'),
+                                       '1500'), self.mtus())
+
+
+class TestChownr(testing.CharmTestCase):
+    """Tests for host.chownr."""
+
+    def setUp(self):
+        super(TestChownr, self).setUp(host, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.top = os.path.join(self.tmpdir, 'lxd')
+        self.outside = os.path.join(self.tmpdir, 'outside')
+        open(self.outside, 'w').close()
+        for d in ('a/x', 'b', 'c'):
+            os.makedirs(os.path.join(self.top, d))
+        for d in ('a', 'a/x', 'b', 'c'):
+            open(os.path.join(self.top, d, 'file'), 'w').close()
+        os.symlink(self.outside, os.path.join(self.top, 'a', 'link'))
+        os.symlink('missing', os.path.join(self.top, 'b', 'broken'))
+        self.entries = ['a', 'a/file', 'a/link', 'a/x', 'a/x/file', 'b',
+                        'b/file', 'c', 'c/file']
+
+    def owners(self, *paths):
+        return [os.lstat(os.path.join(self.top, path)).st_uid
+                for path in paths]
+
+    def chownr(self, **kwargs):
+        root = pwd.getpwuid(0).pw_name
+        with mock.patch.object(host.os, 'chown', wraps=os.chown) as chown:
+            host.chownr(self.top, root, grp.getgrgid(0).gr_name, **kwargs)
+        return chown
+
+    def test_owned_skipped(self):
+        """Entries which already have the right owner are not changed."""
+        if os.getuid() != 0:
+            self.skipTest('needs root')
+
+        self.assertFalse(self.chownr().called)
+
+    def check_chownr(self):
+        if os.getuid() != 0:
+            self.skipTest('needs root')
+        for path in self.entries:
+            os.lchown(os.path.join(self.top, path), 65534, 65534)
+        os.chown(self.outside, 65534, 65534)
+
+        self.chownr(follow_links=False)
+        self.assertEqual([0] * len(self.entries), self.owners(*self.entries))
+        self.assertEqual(65534, os.stat(self.outside).st_uid)
+        self.assertEqual(os.lstat(self.top).st_uid, 0)
+
+        os.lchown(os.path.join(self.top, 'a', 'file'), 65534, 65534)
+        chown = self.chownr(follow_links=True, chowntopdir=True)
+        self.assertEqual(0, os.stat(self.outside).st_uid)
+        self.assertEqual([0], self.owners('a/file'))
+        # The file and the link target; everything else was right already.
+        self.assertEqual(2, chown.call_count)
+
+    def test_fd_walk(self):
+        """Every entry below path is changed, walking directory fds."""
+        self.check_chownr()
+
+    def test_path_walk(self):
+        """Without fd support every entry is changed by path."""
+        with mock.patch.object(host.os, 'supports_fd', set()):
+            self.check_chownr()
+
+
+class TestRandomTokens(testing.CharmTestCase):
+    """Tests for host.random_tokens and host.pwgen."""
+
+    def setUp(self):
+        super(TestRandomTokens, self).setUp(host, [])
+
+    def test_tokens(self):
+        """Tokens have the requested length and use the alphabet only."""
+        tokens = host.random_tokens(50, 20)
+
+        self.assertEqual(50, len(tokens))
+        self.assertEqual(50, len(set(tokens)))
+        for token in tokens:
+            self.assertEqual(20, len(token))
+            self.assertTrue(set(token) <= set(host.PASSWORD_ALPHABET))
+
+    def test_single_read(self):
+        """All tokens come from one os.urandom() read."""
+        with mock.patch.object(host.os, 'urandom',
+                               wraps=os.urandom) as urandom:
+            host.random_tokens(10, 32)
+
+        self.assertEqual(1, urandom.call_count)
+
+    def test_rejection_sampling(self):
+        """Bytes which would bias the result are discarded, reading more
+        until enough are accepted."""
+        # 256 % 3 == 1, so byte 255 is rejected.
+        reads = [b'\xff' * 20, b'\x00\x01\x05\xff' + b'\x02' * 16]
+        with mock.patch.object(host.os, 'urandom', side_effect=reads):
+            tokens = host.random_tokens(2, 2, alphabet='abc')
+
+        self.assertEqual(['ab', 'cc'], tokens)
+
+    def test_entropy(self):
+        """The length can be derived from the bits of entropy wanted."""
+        self.assertEqual(128, len(host.random_token(entropy=128,
+                                                    alphabet='01')))
+        self.assertEqual(22, len(host.random_token(
+            entropy=128, alphabet=string.ascii_letters + string.digits)))
+        self.assertRaises(ValueError, host.random_tokens, 1)
+        self.assertRaises(ValueError, host.random_tokens, 1, 8, alphabet='a')
+
+    def test_pwgen(self):
+        """pwgen passwords are 35 to 44 characters by default."""
+        self.assertTrue(35 <= len(host.pwgen()) < 45)
+        self.assertEqual(8, len(host.pwgen(8)))
+
+
+class TestRestartOnChange(testing.CharmTestCase):
+    """Tests for host.restart_on_change_helper."""
+
+    TO_PATCH = [
+        'service_batch',
+    ]
+
+    def setUp(self):
+        super(TestRestartOnChange, self).setUp(host, self.TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'lxd.conf')
+        self.write('a')
+        self.restart_map = {self.path: ['lxd']}
+        self.db = unitdata.Storage(':memory:')
+        self.addCleanup(self.db.close)
+        patcher = mock.patch.object(unitdata, '_KV', self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, data):
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+    def test_changed(self):
+        """Services are restarted when a file changes, and the new
+        fingerprints are recorded."""
+        host.restart_on_change_helper(lambda: self.write('b'),
+                                      self.restart_map)
+
+        self.service_batch.assert_called_once_with('restart', ['lxd'])
+        self.assertIn(self.path, self.db.get(
+            host.FINGERPRINTS_KEY + self.path))
+
+    def test_unchanged(self):
+        """Nothing is restarted when the files are unchanged."""
+        host.restart_on_change_helper(lambda: None, self.restart_map)
+        host.restart_on_change_helper(lambda: self.write('a'),
+                                      self.restart_map)
+
+        self.assertFalse(self.service_batch.called)
+
+    def test_outside_charm(self):
+        """Without CHARM_DIR changes are detected without creating a unit
+        state database."""
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.tmpdir)
+        env = dict((k, v) for k, v in os.environ.items()
+                   if k not in ('CHARM_DIR', 'UNIT_STATE_DB'))
+        with mock.patch.dict(os.environ, env, clear=True), \
+                mock.patch.object(unitdata, '_KV', None):
+            host.restart_on_change_helper(lambda: self.write('b'),
+                                          self.restart_map)
+
+        self.service_batch.assert_called_once_with('restart', ['lxd'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, '.unit-state.db')))
@@ -0,0 +1,160 @@
+"""Tests for hooks.lxd_hooks."""
+import mock
+
+import lxd_hooks
+import testing
+
+
+class TestLXDHooksInstall(testing.CharmTestCase):
+    """Tests for hooks.lxd_hooks.install."""
+
+    TO_PATCH = [
+        'config',
+        'status_set',
+        'add_source',
+        'apt_update',
+        'apt_install',
+        'apt_lists_stale',
+        'filter_installed_packages',
+        'determine_packages',
+        'install_lxd_source',
+        'configure_lxd_source',
+        'log',
+    ]
+
+    def setUp(self):
+        super(TestLXDHooksInstall, self).setUp(
+            lxd_hooks, self.TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.determine_packages.return_value = ['lxd', 'btrfs-tools']
+
+    def test_install_nothing_missing(self):
+        """apt is not run when all packages are installed."""
+        self.filter_installed_packages.return_value = []
+
+        lxd_hooks.install()
+
+        self.assertFalse(self.apt_update.called)
+        self.assertFalse(self.apt_install.called)
+
+    def test_install_lists_fresh(self):
+        """Missing packages are installed without an apt update when the
+        package lists are current."""
+        self.filter_installed_packages.return_value = ['lxd']
+        self.apt_lists_stale.return_value = False
+
+        lxd_hooks.install()
+
+        self.assertFalse(self.apt_update.called)
+        self.apt_install.assert_called_once_with(['lxd'], fatal=True)
+
+    def test_install_lists_stale(self):
+        """The package lists are updated first when stale."""
+        self.filter_installed_packages.return_value = ['lxd']
+        self.apt_lists_stale.return_value = True
+
+        lxd_hooks.install()
+
+        self.apt_update.assert_called_once_with(fatal=True)
+        self.apt_install.assert_called_once_with(['lxd'], fatal=True)
+
+    def test_install_source(self):
+        """All packages are installed from a configured source, even
+        when already installed."""
+        self.test_config.set('source', 'ppa:ubuntu-lxc/lxd-stable')
+        self.filter_installed_packages.return_value = []
+        self.apt_lists_stale.return_value = True
+
+        lxd_hooks.install()
+
+        self.add_source.assert_called_once_with('ppa:ubuntu-lxc/lxd-stable')
+        self.assertFalse(self.filter_installed_packages.called)
+        self.apt_update.assert_called_once_with(fatal=True)
+        self.apt_install.assert_called_once_with(['lxd', 'btrfs-tools'],
+                                                 fatal=True)
+
+
+class TestLXDHooksConfigChanged(testing.CharmTestCase):
+    """Tests for hooks.lxd_hooks.config_changed."""
+
+    TO_PATCH = [
+        'config',
+        'filesystem_mounted',
+        'umount',
+        'configure_lxd_block',
+        'configure_lxd_host',
+        'log',
+    ]
+
+    def setUp(self):
+        super(TestLXDHooksConfigChanged, self).setUp(
+            lxd_hooks, self.TO_PATCH)
+        self.conf = mock.MagicMock()
+        self.conf.get.side_effect = self.test_config.get
+        self.config.return_value = self.conf
+
+    def test_config_changed_first_run(self):
+        """All configuration steps run when config has changed."""
+        self.conf.any_changed.return_value = True
+
+        lxd_hooks.config_changed()
+
+        self.configure_lxd_block.assert_called_once_with()
+        self.configure_lxd_host.assert_called_once_with()
+
+    def test_config_changed_unchanged(self):
+        """Host configuration is skipped when its options are unchanged,
+        while storage setup is always retried."""
+        self.conf.any_changed.return_value = False
+
+        lxd_hooks.config_changed()
+
+        self.configure_lxd_block.assert_called_once_with()
+        self.assertFalse(self.configure_lxd_host.called)
+
+    def test_config_changed_ephemeral_unmount(self):
+        """The ephemeral mountpoint is unmounted when mounted."""
+        self.test_config.set('ephemeral-unmount', '/mnt')
+        self.filesystem_mounted.return_value = True
+        self.conf.any_changed.return_value = False
+
+        lxd_hooks.config_changed()
+
+        self.umount.assert_called_once_with('/mnt')
+
+
+class TestLXDHooksRelationJoined(testing.CharmTestCase):
+    """Tests for hooks.lxd_hooks.lxd_relation_joined."""
+
+    TO_PATCH = [
+        'gethostname',
+    ]
+
+    FIXTURE = {
+        'unit': 'lxd/0',
+        'relation_id': 'lxd-migration:0',
+        'remote_unit': 'lxd/1',
+        'unit_data': {'private-address': '10.0.0.10'},
+        'relations': {
+            'lxd-migration': {
+                'lxd-migration:0': {'lxd/1': {}},
+            },
+        },
+        'kv': {'lxd-password': 'sekrit'},
+    }
+
+    def setUp(self):
+        super(TestLXDHooksRelationJoined, self).setUp(
+            lxd_hooks, self.TO_PATCH)
+        self.gethostname.return_value = 'lxd-host'
+        self.tools = self.hook_fixture(self.FIXTURE)
+
+    def test_lxd_relation_joined(self):
+        """The trust password, hostname and address are published."""
+        lxd_hooks.lxd_relation_joined()
+
+        self.assertEqual(
+            {'password': 'sekrit',
+             'hostname': 'lxd-host',
+             'address': '10.0.0.10'},
+            self.tools.relation_settings('lxd-migration:0'))
@@ -0,0 +1,536 @@
+"""Tests for charmhelpers.core.unitdata."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+
+class TestStorageAutoVacuum(unittest.TestCase):
+    """Tests for unitdata.Storage enabling incremental auto-vacuum."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+
+    def auto_vacuum(self, db):
+        db.cursor.execute('pragma auto_vacuum')
+        return db.cursor.fetchone()[0]
+
+    def test_new_wal_database(self):
+        """A new WAL database uses incremental auto-vacuum."""
+        db = unitdata.Storage(self.path, journal_mode='wal')
+        self.addCleanup(db.close)
+
+        self.assertEqual(2, self.auto_vacuum(db))
+
+    def test_reopened_wal_database(self):
+        """Incremental auto-vacuum persists when the database is
+        reopened."""
+        unitdata.Storage(self.path, journal_mode='wal').close()
+        db = unitdata.Storage(self.path, journal_mode='wal')
+        self.addCleanup(db.close)
+
+        self.assertEqual(2, self.auto_vacuum(db))
+
+
+class TestStorageGetrange(unittest.TestCase):
+    """Tests for unitdata.Storage.getrange."""
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.update({'a': {'user': 'nova'}, 'b': [1, 2], 'c': 'x'},
+                       prefix='lxd.')
+        self.db.set('lxdx.a', 1)
+        self.db.set('LXD.a', 1)
+        self.db.set('lxd_a', 1)
+
+    def test_dict(self):
+        """A plain dict of decoded values is returned."""
+        values = self.db.getrange('lxd.', strip=True)
+
+        self.assertIsInstance(values, dict)
+        self.assertEqual({'a': {'user': 'nova'}, 'b': [1, 2], 'c': 'x'},
+                         values)
+        self.assertEqual(values, json.loads(json.dumps(values)))
+
+    def test_prefix_literal(self):
+        """The prefix is matched literally and case sensitively."""
+        self.assertEqual(['lxd.a', 'lxd.b', 'lxd.c'],
+                         sorted(self.db.getrange('lxd.')))
+        self.assertEqual(['lxd_a'], list(self.db.getrange('lxd_')))
+        self.assertEqual({}, self.db.getrange('lxd%'))
+
+
+class TestStorageUpdateIsolated(unittest.TestCase):
+    """Tests for unitdata.Storage.update_isolated."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+        self.db = unitdata.Storage(self.path, journal_mode='wal')
+        self.addCleanup(self.db.close)
+
+    def committed(self):
+        db = unitdata.Storage(self.path, readonly=True)
+        try:
+            return dict(db.getrange(''))
+        finally:
+            db.close()
+
+    def test_nothing_pending(self):
+        """Values are committed straight away."""
+        self.db.update_isolated({'status': 'active'}, prefix='hook.')
+
+        self.assertEqual({'hook.status': 'active'}, self.committed())
+
+    def test_pending_flushed(self):
+        """Pending changes are left uncommitted, then committed along with
+        the values on flush."""
+        self.db.set('charm', 1)
+        self.db.update_isolated({'status': 'active'})
+
+        self.assertEqual({}, self.committed())
+        self.db.flush()
+        self.assertEqual({'charm': 1, 'status': 'active'}, self.committed())
+
+    def test_pending_discarded(self):
+        """The values are still committed when pending changes are
+        discarded."""
+        self.db.set('charm', 1)
+        self.db.update_isolated({'status': 'active'})
+
+        self.db.flush(False)
+
+        self.assertEqual({'status': 'active'}, self.committed())
+
+    def test_pending_at_exit(self):
+        """The values are committed at exit when nothing was flushed."""
+        self.db.set('charm', 1)
+        self.db.update_isolated({'status': 'active'})
+
+        self.db._flush_isolated()
+
+        self.assertEqual({'status': 'active'}, self.committed())
+
+    def test_hook_scope_failed(self):
+        """Within a hook scope the values are discarded with the hook."""
+        def hook():
+            with self.db.hook_scope('config-changed'):
+                self.db.update_isolated({'status': 'active'})
+                raise ValueError('boom')
+
+        self.assertRaises(ValueError, hook)
+
+        self.assertEqual({}, self.committed())
+
+
+class TestStorageWrites(unittest.TestCase):
+    """Tests for unitdata.Storage.set and update skipping unchanged
+    values."""
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        self.addCleanup(self.db.close)
+
+    def changes(self, func, *args):
+        before = self.db.conn.total_changes
+        func(*args)
+        return self.db.conn.total_changes - before
+
+    def test_set_unchanged(self):
+        """Setting a key to its current value writes nothing."""
+        self.assertEqual(1, self.changes(self.db.set, 'a', {'x': 1}))
+        self.assertEqual(0, self.changes(self.db.set, 'a', {'x': 1}))
+        self.assertEqual(1, self.changes(self.db.set, 'a', {'x': 2}))
+        self.assertEqual({'x': 2}, self.db.get('a'))
+
+    def test_set_history(self):
+        """Changes in a hook scope are recorded in the history once."""
+        with self.db.hook_scope('install'):
+            self.db.set('a', 1)
+            self.db.set('a', 1)
+        with self.db.hook_scope('config-changed'):
+            self.db.set('a', 1)
+            self.db.set('a', 2)
+
+        self.assertEqual([('a', 1, 'install'), ('a', 2, 'config-changed')],
+                         [(k, v, h) for _, k, v, h, _ in
+                          self.db.gethistory('a', deserialize=True)])
+
+    def test_update_changed_only(self):
+        """update() writes only the keys whose value changed, reading the
+        existing values in chunks."""
+        self.db.update({'a': 1, 'b': 2, 'c': 3}, prefix='x.')
+
+        with mock.patch.object(unitdata, 'MAX_VARIABLES', 2):
+            written = self.changes(self.db.update,
+                                   {'a': 1, 'b': 5, 'c': 3, 'd': 4}, 'x.')
+
+        self.assertEqual(2, written)
+        self.assertEqual({'a': 1, 'b': 5, 'c': 3, 'd': 4},
+                         self.db.getrange('x.', strip=True))
+
+    def test_pragmas(self):
+        """The journal mode and synchronous level are validated and
+        applied."""
+        db = unitdata.Storage(':memory:', journal_mode='memory',
+                              synchronous='off')
+        self.addCleanup(db.close)
+        db.cursor.execute('pragma synchronous')
+        self.assertEqual(0, db.cursor.fetchone()[0])
+
+        self.assertRaises(ValueError, unitdata.Storage, ':memory:',
+                          journal_mode='bogus')
+        self.assertRaises(ValueError, unitdata.Storage, ':memory:',
+                          synchronous='off; drop table kv')
+
+
+class TestStorageCompact(unittest.TestCase):
+    """Tests for unitdata.Storage.compact."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db = unitdata.Storage(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(self.db.close)
+        for value in range(5):
+            with self.db.hook_scope('config-changed'):
+                self.db.set('a', value)
+
+    def history(self):
+        return [v for _, _, v, _, _ in
+                self.db.gethistory('a', deserialize=True)]
+
+    def hooks(self):
+        self.db.cursor.execute('select count(*) from hooks')
+        return self.db.cursor.fetchone()[0]
+
+    def test_keep(self):
+        """History of all but the last hooks is pruned; current values are
+        kept."""
+        self.db.compact(keep=2)
+
+        self.assertEqual([3, 4], self.history())
+        self.assertEqual(2, self.hooks())
+        self.assertEqual(4, self.db.get('a'))
+
+    def test_max_age(self):
+        """Recent history is kept even beyond the last hooks."""
+        self.db.compact(keep=1, max_age=3600)
+        self.assertEqual([0, 1, 2, 3, 4], self.history())
+
+        self.db.cursor.execute(
+            "update hooks set date = '2000-01-01T00:00:00.000000' "
+            "where version < 4")
+        self.db.compact(keep=2, max_age=3600)
+        self.assertEqual([3, 4], self.history())
+
+    def test_nothing_to_prune(self):
+        """Nothing is pruned with fewer hooks recorded than kept."""
+        self.db.compact(keep=10)
+
+        self.assertEqual([0, 1, 2, 3, 4], self.history())
+
+    def test_vacuum(self):
+        """Pages freed by pruning are returned to the filesystem."""
+        with self.db.hook_scope('install'):
+            self.db.set('big', 'x' * 100000)
+        with self.db.hook_scope('config-changed'):
+            self.db.set('big', None)
+        size = os.path.getsize(self.db.db_path)
+
+        self.db.compact(keep=1)
+
+        self.assertLess(os.path.getsize(self.db.db_path), size)
+        self.db.cursor.execute('pragma freelist_count')
+        self.assertEqual(0, self.db.cursor.fetchone()[0])
+
+
+class TestStorageCache(unittest.TestCase):
+    """Tests for unitdata.Storage(cache=True)."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+        db = unitdata.Storage(self.path)
+        db.set('a', {'x': 1})
+        db.flush()
+        db.close()
+        self.db = unitdata.Storage(self.path, journal_mode='wal', cache=True)
+        self.addCleanup(self.db.close)
+
+    def stored(self):
+        db = unitdata.Storage(self.path, readonly=True)
+        try:
+            return db.getrange('')
+        finally:
+            db.close()
+
+    def test_get(self):
+        """Values are served from memory without sharing containers."""
+        with mock.patch.object(self.db, 'cursor') as cursor:
+            value = self.db.get('a')
+            value['x'] = 2
+            self.assertEqual({'x': 1}, self.db.get('a'))
+            self.assertEqual('default', self.db.get('b', 'default'))
+
+        self.assertFalse(cursor.execute.called)
+
+    def test_write_back(self):
+        """Changes are written on flush, and before SQL reads."""
+        self.db.set('b', 2)
+        self.db.update({'c': 3})
+        self.assertEqual({'a': {'x': 1}}, self.stored())
+
+        self.assertEqual({'a': {'x': 1}, 'b': 2, 'c': 3},
+                         self.db.getrange(''))
+        self.db.flush()
+        self.assertEqual({'a': {'x': 1}, 'b': 2, 'c': 3}, self.stored())
+
+    def test_discard(self):
+        """flush(False) discards changes and reloads the cache."""
+        self.db.set('a', 2)
+        self.db.unset('a')
+
+        self.db.flush(False)
+
+        self.assertEqual({'x': 1}, self.db.get('a'))
+
+    def test_history(self):
+        """Changes are recorded in the history of their hook."""
+        with self.db.hook_scope('config-changed'):
+            self.db.set('a', 2)
+
+        self.assertEqual([2], [v for _, _, v, _, _ in
+                               self.db.gethistory('a', deserialize=True)])
+        self.assertEqual(2, self.stored()['a'])
+
+
+class TestStorageDelta(unittest.TestCase):
+    """Tests for unitdata.Storage.delta."""
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.update({'a': 1, 'b': [1, 2], 'c': 'x'}, prefix='config.')
+        self.db.set('config_d', 1)
+        self.db.flush()
+
+    def test_delta(self):
+        """Added, changed and removed keys are reported."""
+        delta = self.db.delta({'a': 1, 'b': [1, 3], 'd': True}, 'config.')
+
+        self.assertEqual({'b': ([1, 2], [1, 3]),
+                          'c': ('x', None),
+                          'd': (None, True)}, delta)
+        self.assertEqual({'a': 1, 'b': [1, 2], 'c': 'x'},
+                         self.db.getrange('config.', strip=True))
+
+    def test_unchanged_not_decoded(self):
+        """Only values whose serialization differs are decoded."""
+        with mock.patch.object(unitdata, '_decode',
+                               wraps=unitdata._decode) as decode:
+            delta = self.db.delta({'a': 1, 'b': [1, 2], 'c': 'y'}, 'config.')
+
+        self.assertEqual({'c': ('x', 'y')}, delta)
+        decode.assert_called_once_with('"x"')
+
+    def test_apply(self):
+        """apply stores the mapping and removes stale keys, recording
+        history."""
+        with self.db.hook_scope('config-changed'):
+            self.db.delta({'a': 2, 'b': [1, 2]}, 'config.', apply=True)
+
+        self.assertEqual({'a': 2, 'b': [1, 2]},
+                         self.db.getrange('config.', strip=True))
+        self.assertEqual(1, self.db.get('config_d'))
+        self.assertEqual(['DELETED'], [v for _, _, v, _, _ in
+                                       self.db.gethistory(
+                                           'config.c', deserialize=True)])
+        self.assertEqual({}, self.db.delta({'a': 2, 'b': [1, 2]}, 'config.'))
+
+    def test_scratch_table_emptied(self):
+        """The temp table is left empty and delta() does not commit."""
+        self.db.set('config.a', 5)
+        self.db.delta({'a': 1}, 'config.')
+        self.db.cursor.execute('select count(*) from temp.kv_delta')
+        self.assertEqual(0, self.db.cursor.fetchone()[0])
+
+        self.db.flush(False)
+
+        self.assertEqual(1, self.db.get('config.a'))
+
+
+class TestStorageCodecs(unittest.TestCase):
+    """Tests for unitdata.Storage value codecs and compression."""
+
+    VALUE = {'key': 'x' * 1000, 'list': [1, 2.5, None, True]}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+
+    def storage(self, **kwargs):
+        db = unitdata.Storage(self.path, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def raw(self, db, key):
+        db.cursor.execute('select data from kv where key = ?', [key])
+        return db.cursor.fetchone()[0]
+
+    def test_marshal(self):
+        """marshal keeps bytes and tuples, and its rows are readable with
+        the json codec."""
+        db = self.storage(codec='marshal')
+        db.set('a', {'data': b'\x00\xff', 'pair': (1, 2)})
+        db.set('b', self.VALUE)
+        db.flush()
+
+        self.assertEqual({'data': b'\x00\xff', 'pair': (1, 2)}, db.get('a'))
+        self.assertEqual(b'm', bytes(self.raw(db, 'a'))[:1])
+        self.assertEqual(self.VALUE, self.storage().get('b'))
+
+    @unittest.skipIf(unitdata.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        """msgpack rows round trip and are readable with the json codec."""
+        db = self.storage(codec='msgpack')
+        db.set('a', self.VALUE)
+        db.flush()
+
+        self.assertEqual(b'p', bytes(self.raw(db, 'a'))[:1])
+        self.assertEqual(self.VALUE, self.storage().get('a'))
+
+    def test_compress(self):
+        """Values over the threshold are compressed; small ones stay plain
+        JSON text."""
+        db = self.storage(compress_threshold=100)
+        db.update({'big': self.VALUE, 'small': 1})
+
+        self.assertEqual(b'z', bytes(self.raw(db, 'big'))[:1])
+        self.assertLess(len(self.raw(db, 'big')), 100)
+        self.assertEqual('1', self.raw(db, 'small'))
+        self.assertEqual({'big': self.VALUE, 'small': 1}, db.getrange(''))
+
+    def test_unchanged_compressed(self):
+        """Rewriting the same compressed value is skipped."""
+        db = self.storage(codec='marshal', compress_threshold=100)
+        db.set('big', self.VALUE)
+        changes = db.conn.total_changes
+
+        db.set('big', self.VALUE)
+        db.update({'big': self.VALUE})
+
+        self.assertEqual(changes, db.conn.total_changes)
+
+    def test_migrate(self):
+        """migrate() rewrites current values and history."""
+        db = self.storage()
+        with db.hook_scope('install'):
+            db.set('a', self.VALUE)
+        db.close()
+        db = self.storage(codec='marshal')
+
+        self.assertEqual(2, db.migrate())
+        self.assertEqual(0, db.migrate())
+        self.assertEqual(b'm', bytes(self.raw(db, 'a'))[:1])
+        self.assertEqual(self.VALUE, db.get('a'))
+        self.assertEqual([self.VALUE], [v for _, _, v, _, _ in
+                                        db.gethistory('a', deserialize=True)])
+
+    def test_invalid_codec(self):
+        """Unknown codecs, and msgpack when not installed, are refused."""
+        self.assertRaises(ValueError, unitdata.Storage, ':memory:',
+                          codec='pickle')
+        with mock.patch.object(unitdata, 'msgpack', None):
+            self.assertRaises(ValueError, unitdata.Storage, ':memory:',
+                              codec='msgpack')
+            self.assertRaises(ValueError, unitdata._decode,
+                              unitdata.sqlite3.Binary(b'p\x01'))
+
+
+class TestStorageBusy(unittest.TestCase):
+    """Tests for unitdata.Storage sharing the database with other
+    connections."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+        patcher = mock.patch.object(unitdata.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def storage(self, **kwargs):
+        db = unitdata.Storage(self.path, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def test_retry_busy(self):
+        """Busy errors are retried with growing delays."""
+        func = mock.Mock(side_effect=[
+            unitdata.sqlite3.OperationalError('database is locked'),
+            unitdata.sqlite3.OperationalError('database is busy'),
+            'done'])
+
+        self.assertEqual('done', unitdata._retry_busy(func, 1))
+
+        func.assert_called_with(1)
+        self.assertEqual(3, func.call_count)
+        first, second = [c[0][0] for c in self.sleep.call_args_list]
+        self.assertLess(first, second)
+
+    def test_retry_gives_up(self):
+        """The error is raised once the retries are used up, and other
+        errors straight away."""
+        busy = mock.Mock(side_effect=unitdata.sqlite3.OperationalError(
+            'database is locked'))
+        self.assertRaises(unitdata.sqlite3.OperationalError,
+                          unitdata._retry_busy, busy)
+        self.assertEqual(unitdata.BUSY_RETRIES + 1, busy.call_count)
+
+        error = mock.Mock(side_effect=unitdata.sqlite3.OperationalError(
+            'no such table: kv'))
+        self.assertRaises(unitdata.sqlite3.OperationalError,
+                          unitdata._retry_busy, error)
+        self.assertEqual(1, error.call_count)
+
+    def test_locked_write_retried(self):
+        """A write blocked by another connection's transaction succeeds
+        once the lock is released."""
+        holder = self.storage(journal_mode='wal')
+        db = self.storage(journal_mode='wal', timeout=0)
+        holder.set('a', 1)
+        self.sleep.side_effect = lambda delay: holder.flush()
+
+        db.set('b', 2)
+        db.flush()
+
+        self.assertTrue(self.sleep.called)
+        self.assertEqual({'a': 1, 'b': 2}, self.storage().getrange(''))
+
+    def test_readonly(self):
+        """A read-only Storage reads alongside a writer but cannot
+        write."""
+        writer = self.storage(journal_mode='wal')
+        writer.set('a', 1)
+        writer.flush()
+        writer.set('a', 2)
+
+        reader = self.storage(readonly=True)
+
+        self.assertEqual(1, reader.get('a'))
+        self.assertEqual({'a': (1, 2)}, reader.delta({'a': 2}, ''))
+        self.assertRaises(unitdata.sqlite3.OperationalError,
+                          reader.set, 'b', 1)
+        self.assertFalse(self.sleep.called)
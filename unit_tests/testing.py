@@ -6,6 +6,12 @@ import yaml
 from contextlib import contextmanager
 from mock import patch, MagicMock
 
+from charmhelpers.core import hookenv
+from charmhelpers.core.hookfixture import hook_fixture
+
+# The real status_set, for testing hookenv itself.
+hookenv_status_set = hookenv.status_set
+
 patch('charmhelpers.contrib.openstack.utils.set_os_workload_status').start()
 patch('charmhelpers.core.hookenv.status_set').start()
 
@@ -67,6 +73,17 @@ class CharmTestCase(unittest.TestCase):
         for method in self.patches:
             setattr(self, method, self.patch(method))
 
+    def hook_fixture(self, fixture):
+        '''
+        Run the rest of the test against an in-memory hook environment
+        built from fixture (see charmhelpers.core.hookfixture) and return
+        its hook tool backend.
+        '''
+        ctxt = hook_fixture(fixture)
+        tools = ctxt.__enter__()
+        self.addCleanup(ctxt.__exit__, None, None, None)
+        return tools
+
 
 class TestConfig(object):
 